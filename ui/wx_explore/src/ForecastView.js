@@ -13,8 +13,10 @@ const lineColors = {
   'nam':  '0,0,255',
 };
 
+const temperatureMetricId = "1";
+
 const metricsToDisplay = [
-  "1", // temperature
+  temperatureMetricId,
   "3", // rain
   "6", // snow
   "12", // wind
@@ -47,6 +49,7 @@ export default class ForecastView extends React.Component {
         lon: this.state.location.lon,
         start: t,
         end: t + (3 * 24 * 60 * 60), // 3 days out
+        rollup: 'mean', // hourly data is all that's shown
       },
     }).then(({data}) => this.setState({wx: data}));
 
@@ -190,6 +193,8 @@ export default class ForecastView extends React.Component {
 
   coreMetricsBox(day) {
     const summary = this.state.summary[day];
+    // Summaries are in the temperature metric's units, like its data points
+    const tempUnits = this.state.metrics[temperatureMetricId].units;
 
     let cloudCoverIcon = '';
     switch (summary.cloud_cover[0].cover) {
@@ -218,9 +223,9 @@ export default class ForecastView extends React.Component {
           <i style={{fontSize: "7em"}} className={"wi " + cloudCoverIcon}></i>
         </Col>
         <Col md={3}>
-          <h4>{this.props.converter.convert(summary.temps[0].temperature, 'K')} {capitalize(summary.cloud_cover[0].cover)}</h4>
-          <p>High: {this.props.converter.convert(summary.high.temperature, 'K')}</p>
-          <p>Low: {this.props.converter.convert(summary.low.temperature, 'K')}</p>
+          <h4>{this.props.converter.convert(summary.temps[0].temperature, tempUnits)} {capitalize(summary.cloud_cover[0].cover)}</h4>
+          <p>High: {this.props.converter.convert(summary.high.temperature, tempUnits)}</p>
+          <p>Low: {this.props.converter.convert(summary.low.temperature, tempUnits)}</p>
         </Col>
       </Row>
     );
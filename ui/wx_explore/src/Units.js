@@ -20,6 +20,8 @@ export class Imperial extends UnitConverter {
         switch (unit) {
             case 'K':
                 return this.round(((val - 273.15) * 1.8) + 32, 'F');
+            case 'C':
+                return this.round((val * 1.8) + 32, 'F');
             case 'm':
                 return this.round(val * 3.2808, 'ft');
             case 'm/s':
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Times combine_models over a realistic /wx/summarize workload (10 days of every summarized metric from
+HRRR, NAM and GFS at one location) against the previous per-point implementation. Both are timed over the
+whole workload, and the previous implementation's metric lookups are served from a dict so no DB time is counted.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+import argparse
+import numpy
+import time
+
+from wx_explore.analysis.summarize import combine_models
+from wx_explore.common import metrics
+from wx_explore.common.models import DataPointBatch, DataPointBatchBuilder, DataPointSet, Source, SourceField
+from wx_explore.web.core import app
+
+SUMMARIZED_METRICS = [
+    metrics.temp,
+    metrics.raining,
+    metrics.snowing,
+    metrics.wind_speed,
+    metrics.wind_direction,
+    metrics.gust_speed,
+    metrics.cloud_cover,
+    metrics.composite_reflectivity,
+]
+
+# Source -> (forecast length, step between frames)
+MODEL_RANGES = {
+    'hrrr': (timedelta(hours=18), timedelta(minutes=15)),
+    'nam': (timedelta(hours=84), timedelta(hours=1)),
+    'gfs': (timedelta(days=10), timedelta(hours=1)),
+}
+
+
+def combine_models_per_point(model_data: Iterable[DataPointSet], metric_ids: Dict[int, int]) -> List[DataPointSet]:
+    """
+    The previous combine_models, which looked up each point's metric from its source field (with get_metric).
+    :param metric_ids: Map of source field id -> metric id, standing in for get_metric
+    """
+    combined_sets: Dict[Tuple[int, datetime], DataPointSet] = {}
+
+    for model_data_point in model_data:
+        metric_id = metric_ids[model_data_point.source_field_id]
+        if (metric_id, model_data_point.valid_time) not in combined_sets:
+            combined_sets[(metric_id, model_data_point.valid_time)] = DataPointSet(
+                values=[],
+                metric_id=metric_id,
+                valid_time=model_data_point.valid_time,
+                synthesized=True
+            )
+
+        combined_sets[(metric_id, model_data_point.valid_time)].values.extend(model_data_point.values)
+
+    return list(combined_sets.values())
+
+
+def make_workload(start: datetime) -> DataPointBatch:
+    """
+    :return: Points of every summarized metric of each model over its forecast range, as the backends return them
+    """
+    rng = numpy.random.default_rng(0)
+    builder = DataPointBatchBuilder()
+
+    for source_name, (length, step) in MODEL_RANGES.items():
+        source = Source.query.filter_by(short_name=source_name).first()
+        if source is None:
+            continue
+
+        for metric in SUMMARIZED_METRICS:
+            sf = SourceField.query.filter_by(source_id=source.id, metric_id=metric.id).first()
+            if sf is None:
+                continue
+
+            for i in range(int(length / step)):
+                builder.append(rng.random(1), metric.id, start + step * i, source_field_id=sf.id, run_time=start)
+
+    return builder.build()
+
+
+def timed(func, *args, repeat=10) -> float:
+    """
+    :return: Best time (seconds) of repeat calls of func
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark combine_models')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs of each implementation (the best is reported)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        workload = make_workload(datetime.utcnow().replace(minute=0, second=0, microsecond=0))
+        # Plain DataPointSets, as the backends returned before DataPointBatch
+        points = [DataPointSet(dp.values, dp.metric_id, dp.valid_time, dp.source_field_id, dp.run_time) for dp in workload]
+        metric_ids = {dp.source_field_id: dp.metric_id for dp in points}
+
+        print(f"{len(workload)} points, {len(combine_models(workload))} combined (times are for all points)")
+        print(f"per point (DataPointSets): {timed(combine_models_per_point, points, metric_ids, repeat=args.repeat) * 1000:.2f} ms")
+        print(f"vectorized (DataPointBatch): {timed(combine_models, workload, repeat=args.repeat) * 1000:.2f} ms")
@@ -1,61 +1,72 @@
+import concurrent.futures
 import cv2
 import numpy as np
-import pygrib
 
 
-def warp_flow(img, flow):
-    h, w = flow.shape[:2]
-    flow = -flow
-    flow[:,:,0] += np.arange(w)
-    flow[:,:,1] += np.arange(h)[:,np.newaxis]
-    res = cv2.remap(img, flow, None, cv2.INTER_LINEAR)
-    return res
-
-
-def interpolate(msg_a, msg_b):
+def compute_flow(frame_a, frame_b):
     """
-    Interpolate values from GRIB message A to message B, in 1 minute steps.
+    Dense optical flow (per-pixel [dx, dy], float32) from frame A to frame B.
     """
-    dt = msg_b.forecastTime - msg_a.forecastTime
-
-    frame_a, lat, lon = msg_a.data()
-    frame_b = msg_b.values
-
-    frame_a = frame_a.clip(min=0).astype(np.uint8)
-    frame_b = frame_b.clip(min=0).astype(np.uint8)
-
-    #frame_a = cv2.adaptiveThreshold(frame_a, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 31, 0)
-    #frame_b = cv2.adaptiveThreshold(frame_b, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 31, 0)
+    img_a = frame_a.clip(min=0, max=255).astype(np.uint8)
+    img_b = frame_b.clip(min=0, max=255).astype(np.uint8)
 
     # TODO: param tuning
-    flow = cv2.calcOpticalFlowFarneback(frame_a, frame_b, None, 0.3, 3, 15, 3, 5, 1.2, 0)
-
     # TODO: flow validation based on wind (i.e. flow direction should not significantly deviate from wind direction)
+    return cv2.calcOpticalFlowFarneback(img_a, img_b, None, 0.3, 3, 15, 3, 5, 1.2, 0)
+
+
+def pixel_grid(shape):
+    """
+    :return: float32 [h, w, 2] array of each pixel's (x, y), the identity map for cv2.remap
+    """
+    h, w = shape
+    grid = np.empty((h, w, 2), dtype=np.float32)
+    grid[:, :, 0] = np.arange(w, dtype=np.float32)
+    grid[:, :, 1] = np.arange(h, dtype=np.float32)[:, np.newaxis]
+    return grid
 
-    # Create 2 series: one of a flowing to b, one of b flowing to a (-flow)
-    # Final result will fade between the two of them
 
-    a_to_b = [frame_a]
-    for i in range(1, dt):
-        a_to_b.append(warp_flow(a_to_b[i-1], flow/dt))
+def warp_flow(img, flow, grid=None):
+    """
+    Moves img along flow (i.e. samples img at each pixel minus its flow).
+    """
+    if grid is None:
+        grid = pixel_grid(flow.shape[:2])
+    return cv2.remap(img, grid - flow, None, cv2.INTER_LINEAR)
 
-    b_to_a = [frame_b]
-    for i in range(dt-1, 0, -1):
-        b_to_a.insert(0, warp_flow(b_to_a[-1], (-flow)/dt))
 
-    res = np.mean([a_to_b, b_to_a], axis=0)
+def interpolate_frame(frame_a, frame_b, flow, t, grid):
+    """
+    Frame at fraction t (0 < t < 1) of the way from A to B: A moved forward along t of the flow, faded into
+    B moved backward along the remaining 1-t of it. Depends only on A, B and the flow, never other frames,
+    so errors don't compound and frames can be computed in any order.
+    """
+    res = warp_flow(frame_a, flow * t, grid)
+    res *= 1 - t
+    res += t * warp_flow(frame_b, flow * (t - 1), grid)
+    return res
 
-    msgs = []
 
-    # Dumb way to copy the message object
-    msg_template = pygrib.fromstring(msg_a.tostring())
+def interpolate(frame_a, frame_b, steps, n_workers=None):
+    """
+    Interpolate values from frame A to frame B.
+    :param frame_a: 2D array of values at the start of the interval
+    :param frame_b: 2D array of values at the end of the interval
+    :param steps: Number of steps (e.g. minutes) between A and B
+    :param n_workers: Number of frames to compute at once (cv2 and numpy release the GIL)
+    :return: The steps-1 float32 frames strictly between A and B
+    """
+    frame_a = np.asarray(frame_a, dtype=np.float32)
+    frame_b = np.asarray(frame_b, dtype=np.float32)
 
-    for i, frame in enumerate(res):
-        msg_template.values = frame.astype(np.float32)
-        msg_template.forecastTime = msg_a.forecastTime + i
-        msgs.append(pygrib.fromstring(msg_template.tostring()))
+    flow = compute_flow(frame_a, frame_b)
+    grid = pixel_grid(frame_a.shape)
 
-    return msgs
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as ex:
+        return list(ex.map(
+            lambda i: interpolate_frame(frame_a, frame_b, flow, i / steps, grid),
+            range(1, steps),
+        ))
 
 
 def _render(msg, out_filename):
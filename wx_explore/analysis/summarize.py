@@ -5,41 +5,64 @@ import math
 import numpy
 import itertools
 
-from wx_explore.analysis.helpers import (
-    get_metric,
-    group_by_time,
-)
 from wx_explore.common import metrics
 from wx_explore.common.models import (
     Metric,
+    DataPointBatch,
     DataPointSet,
 )
 from wx_explore.common.utils import (
     RangeDict,
     ContinuousTimeList,
+    datetime2unix,
+    unix2datetime,
 )
 
 
-def combine_models(model_data: Iterable[DataPointSet]) -> List[DataPointSet]:
-    """
-    Group data from all models in loc_data by metric, returning one DataPointSet
-    for each metric.
-    """
-    combined_sets: Dict[Tuple[int, datetime.datetime], DataPointSet] = {}
-
-    for model_data_point in model_data:
-        metric = get_metric(model_data_point.source_field_id)
-        if (metric.id, model_data_point.valid_time) not in combined_sets:
-            combined_sets[(metric.id, model_data_point.valid_time)] = DataPointSet(
-                values=[],
-                metric_id=metric.id,
-                valid_time=model_data_point.valid_time,
-                synthesized=True
-            )
+# Source of the model blend (see wx_explore.ingest.blend). Summaries use it in place of the models themselves.
+BLEND_SOURCE = 'blend'
 
-        combined_sets[(metric.id, model_data_point.valid_time)].values.extend(model_data_point.values)
+# Source of the precomputed per-cell daily aggregates (see wx_explore.ingest.daily)
+DAILY_SOURCE = 'daily'
 
-    return list(combined_sets.values())
+# Metric id -> names of the values (members) of its daily aggregate field, in order.
+# Onsets and the hours of the high/low are hours after the start of the (UTC) day, and durations are in hours.
+DAILY_VALUES = {
+    metrics.temp.id: ('high', 'low', 'high_hour', 'low_hour'),
+    metrics.raining.id: ('onset', 'duration'),
+    metrics.snowing.id: ('onset', 'duration'),
+    metrics.cloud_cover.id: ('dominant',),
+}
+
+
+def combine_models(model_data: Iterable[DataPointSet]) -> DataPointBatch:
+    """
+    Group data from all models in loc_data by metric, returning one (synthesized) data point
+    for each metric and valid time, holding the values of every model.
+    """
+    batch = DataPointBatch.of(model_data)
+    if not len(batch):
+        return batch
+
+    # Sort points by (metric, valid time), stably so each group's values stay in model order
+    batch = batch.take(numpy.lexsort((batch.valid_time, batch.metric_id)))
+
+    group_starts = numpy.flatnonzero(numpy.concatenate((
+        [True],
+        (batch.metric_id[1:] != batch.metric_id[:-1]) | (batch.valid_time[1:] != batch.valid_time[:-1]),
+    )))
+    offsets = numpy.zeros(len(group_starts) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.add.reduceat(batch.counts, group_starts), out=offsets[1:])
+
+    return DataPointBatch(
+        metric_id=batch.metric_id[group_starts],
+        source_field_id=numpy.full(len(group_starts), DataPointBatch.NO_FIELD),
+        valid_time=batch.valid_time[group_starts],
+        run_time=numpy.full(len(group_starts), DataPointBatch.NO_TIME),
+        offsets=offsets,
+        values=batch.values,
+        synthesized=numpy.ones(len(group_starts), dtype=bool),
+    )
 
 
 def time_of_day(dt):
@@ -209,7 +232,9 @@ class SummarizedData(object):
     end: datetime.datetime
     resolution: datetime.timedelta
 
-    data_points: List[DataPointSet]
+    data_points: DataPointBatch
+    # Median of each of data_points
+    medians: numpy.ndarray
 
     # There are two different types of summarized datas:
     # Continuous metrics (one per resolution unit)
@@ -222,19 +247,27 @@ class SummarizedData(object):
     low: Optional[TemperatureEvent]
     high: Optional[TemperatureEvent]
 
+    # Precomputed daily aggregates (metric id -> values, see DAILY_VALUES) if the range is a whole day
+    daily: Optional[Dict[int, List[float]]]
+
     def __init__(
             self,
             start: datetime.datetime,
             end: datetime.datetime,
             data_points: Iterable[DataPointSet],
             resolution: datetime.timedelta = datetime.timedelta(hours=1),
+            daily: Optional[Dict[int, List[float]]] = None,
     ):
         self.start = start
         self.end = end
         self.resolution = resolution
+        self.daily = daily
 
-        # Bound data points to within the specified start,end
-        self.data_points = sorted(filter(lambda d: start <= d.valid_time < end, data_points), key=lambda p: p.valid_time)
+        # Bound data points to within the specified start,end, in time order
+        data_points = DataPointBatch.of(data_points)
+        in_range = numpy.flatnonzero((data_points.valid_time >= datetime2unix(start)) & (data_points.valid_time < datetime2unix(end)))
+        self.data_points = data_points.take(in_range[numpy.argsort(data_points.valid_time[in_range], kind='stable')])
+        self.medians = self.data_points.medians()
 
         # temps, winds, and cloud cover are guaranteed to have values for each time interval
         self.temps = ContinuousTimeList(start, end, resolution)
@@ -252,56 +285,79 @@ class SummarizedData(object):
 
         self.analyze()
 
-    def points_for_metric(self, m: Metric) -> List[DataPointSet]:
-        return list(filter(lambda d: d.metric_id == m.id, self.data_points))
+    def points_for_metric(self, m: Metric) -> Dict[datetime.datetime, float]:
+        """
+        :return: Map of valid time -> median of each point of m, in time order. Points without a median
+                 (all of their values are NaN, i.e. masked) are left out.
+        """
+        is_metric = (self.data_points.metric_id == m.id) & ~numpy.isnan(self.medians)
+        return dict(zip(
+            map(unix2datetime, self.data_points.valid_time[is_metric].tolist()),
+            self.medians[is_metric].tolist(),
+        ))
+
+    def daily_values(self, m: Metric) -> Optional[Dict[str, float]]:
+        """
+        :return: Map of value name -> value of the precomputed daily aggregate of m, if there is one
+        """
+        if self.daily is None or m.id not in self.daily or all(math.isnan(v) for v in self.daily[m.id]):
+            return None
+        return dict(zip(DAILY_VALUES[m.id], self.daily[m.id]))
+
+    def daily_time(self, hour: Optional[float]) -> datetime.datetime:
+        """
+        :return: Time of an hour of a daily aggregate, or the start of the day if it doesn't have the hour
+                 (aggregates stored before it was added)
+        """
+        if hour is None or math.isnan(hour):
+            return self.start
+        return self.start + datetime.timedelta(hours=hour)
 
     def analyze(self):
-        for data_point in self.data_points:
-            if data_point.metric_id == metrics.temp.id:
-                e = TemperatureEvent(data_point.valid_time, data_point.median())
-                self.temps[e.time] = e
-
-                if self.low is None or e.temperature < self.low.temperature:
-                    self.low = e
-                if self.high is None or e.temperature > self.high.temperature:
-                    self.high = e
-
-        for valid_time, (wind_speed, wind_direction, gust_speed) in group_by_time([
-                self.points_for_metric(metrics.wind_speed),
-                self.points_for_metric(metrics.wind_direction),
-                self.points_for_metric(metrics.gust_speed),
-        ]):
-            e = WindEvent(valid_time, wind_speed.median(), wind_direction.median(), gust_speed.median())
+        for valid_time, temperature in self.points_for_metric(metrics.temp).items():
+            e = TemperatureEvent(valid_time, temperature)
+            self.temps[e.time] = e
+
+            if self.low is None or e.temperature < self.low.temperature:
+                self.low = e
+            if self.high is None or e.temperature > self.high.temperature:
+                self.high = e
+
+        # The daily aggregates are of the blend only, so are just used when no model has hourly temps for the range
+        daily_temp = self.daily_values(metrics.temp)
+        if self.high is None and daily_temp is not None:
+            self.high = TemperatureEvent(self.daily_time(daily_temp.get('high_hour')), daily_temp['high'])
+            self.low = TemperatureEvent(self.daily_time(daily_temp.get('low_hour')), daily_temp['low'])
+
+        wind_speeds = self.points_for_metric(metrics.wind_speed)
+        wind_directions = self.points_for_metric(metrics.wind_direction)
+        gust_speeds = self.points_for_metric(metrics.gust_speed)
+        for valid_time in sorted(wind_speeds.keys() & wind_directions.keys() & gust_speeds.keys()):
+            e = WindEvent(valid_time, wind_speeds[valid_time], wind_directions[valid_time], gust_speeds[valid_time])
             self.winds[e.time] = e
 
-        for cover, grp in itertools.groupby(self.points_for_metric(metrics.cloud_cover), key=lambda p: CloudCoverEvent.CLASSIFICATIONS[p.median()]):
+        for cover, grp in itertools.groupby(self.points_for_metric(metrics.cloud_cover).items(), key=lambda p: CloudCoverEvent.CLASSIFICATIONS[p[1]]):
             grp = list(grp)
-            start = grp[0].valid_time
-            end = grp[-1].valid_time
+            start = grp[0][0]
+            end = grp[-1][0]
             e = CloudCoverEvent(start, end, cover)
             self.cloud_cover[e.start:e.end] = e
 
-        raining = list(filter(lambda d: d.median() == 1, self.points_for_metric(metrics.raining)))
-        for intensity, grp in itertools.groupby(
-                [(time, rain, refl) for time, (rain, refl) in group_by_time([
-                    raining,
-                    self.points_for_metric(metrics.composite_reflectivity)])],
-                key=lambda t: PrecipEvent.CLASSIFICATIONS[t[2].median()]):
+        refls = self.points_for_metric(metrics.composite_reflectivity)
+
+        raining = [t for t, rain in self.points_for_metric(metrics.raining).items() if rain == 1 and t in refls]
+        for intensity, grp in itertools.groupby(raining, key=lambda t: PrecipEvent.CLASSIFICATIONS[refls[t]]):
             grp = list(grp)
-            start = grp[0][0]
-            end = grp[-1][0]
+            start = grp[0]
+            end = grp[-1]
             e = PrecipEvent(start, end, 'rain', intensity)
             self.precip[e.start:e.end] = e
 
-        snowing = list(filter(lambda d: d.median() == 1, self.points_for_metric(metrics.snowing)))
-        for intensity, grp in itertools.groupby(
-                [(time, snow, refl) for time, (snow, refl) in group_by_time([
-                    snowing,
-                    self.points_for_metric(metrics.composite_reflectivity)])],
-                key=lambda t: PrecipEvent.CLASSIFICATIONS[t[2].median()]):
+        snowing = [t for t, snow in self.points_for_metric(metrics.snowing).items() if snow == 1 and t in refls]
+        for intensity, grp in itertools.groupby(snowing, key=lambda t: PrecipEvent.CLASSIFICATIONS[refls[t]]):
             grp = list(grp)
-            start = grp[0][0]
-            end = grp[-1][0]
+            start = grp[0]
+            end = grp[-1]
             e = PrecipEvent(start, end, 'snow', intensity)
             for t, pe in self.precip.enumerate(e.start, e.end):
                 if pe.ptype == 'rain':
@@ -410,6 +466,31 @@ class SummarizedData(object):
 
         return components
 
+    def daily_summary(self) -> Optional[Dict[str, Any]]:
+        """
+        Precip windows and dominant sky condition of the day from the precomputed daily aggregates.
+        """
+        if self.daily is None:
+            return None
+
+        precip = []
+        for ptype, m in (('rain', metrics.raining), ('snow', metrics.snowing)):
+            vals = self.daily_values(m)
+            if vals is not None and not math.isnan(vals['onset']) and vals['duration'] > 0:
+                start = self.start + datetime.timedelta(hours=vals['onset'])
+                precip.append({
+                    "type": ptype,
+                    "start": start,
+                    "end": start + datetime.timedelta(hours=vals['duration']),
+                })
+
+        cloud_cover = self.daily_values(metrics.cloud_cover)
+
+        return {
+            "precip": sorted(precip, key=lambda p: p['start']),
+            "cloud_cover": CloudCoverEvent.CLASSIFICATIONS[cloud_cover['dominant']] if cloud_cover is not None else None,
+        }
+
     def dict(self):
         summary = self.summarize()
         text_summary = ' '.join(c['text'] for c in summary)
@@ -421,6 +502,7 @@ class SummarizedData(object):
             "winds": [e.dict() if e is not None else None for e in self.winds],
             "cloud_cover": [e.dict() if e is not None else None for e in self.cloud_cover],
             "precip": [e.dict() if e is not None else None for e in self.precip],
+            "daily": self.daily_summary(),
             "summary": {
                 "components": summary,
                 "full_text": text_summary,
@@ -5,11 +5,12 @@ def cartesian_to_polar(u, v):
     """
     Transforms U,V into r,theta, with theta being relative to north (instead of east, a.k.a. the x-axis).
     Mainly for wind U,V to wind speed,direction transformations.
+    Works on real arrays of any float dtype (no complex intermediates), and only allocates the two outputs.
     """
-    c = u + v*1j
-    r = numpy.abs(c)
-    theta = numpy.angle(c, deg=True)
+    r = numpy.hypot(u, v)
+    theta = numpy.arctan2(v, u)
+    numpy.degrees(theta, out=theta)
     # Convert angle relative to the x-axis to a north-relative angle
-    theta -= 90
-    theta = -theta % 360
+    numpy.subtract(90, theta, out=theta)
+    numpy.mod(theta, 360, out=theta)
     return r, theta
@@ -8,10 +8,27 @@ class Config():
     POSTGRES_PORT = int(os.environ.get('POSTGRES_PORT', 5464))
     POSTGRES_DB = os.environ.get('POSTGRES_DB', 'postgres')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    DATA_PROVIDER = "MONGO"
+    DATA_PROVIDER = os.environ.get('DATA_PROVIDER', "MONGO")
     INGEST_MONGO_SERVER_URI = os.environ.get('INGEST_MONGO_SERVER_URI', 'mongodb://localhost:27017/')
     INGEST_MONGO_DATABASE = os.environ.get('INGEST_MONGO_DATABASE', 'wx')
     INGEST_MONGO_COLLECTION = os.environ.get('INGEST_MONGO_COLLECTION', 'wx')
+    INGEST_AZURE_TABLE_ACCOUNT_NAME = os.environ.get('INGEST_AZURE_TABLE_ACCOUNT_NAME', None)
+    INGEST_AZURE_TABLE_ACCOUNT_KEY = os.environ.get('INGEST_AZURE_TABLE_ACCOUNT_KEY', None)
+    INGEST_AZURE_TABLE_NAME = os.environ.get('INGEST_AZURE_TABLE_NAME', 'wx')
+    # Overrides account name/key, e.g. to point at a local Azurite table emulator
+    INGEST_AZURE_TABLE_CONNECTION_STRING = os.environ.get('INGEST_AZURE_TABLE_CONNECTION_STRING', None)
+    # Local disk cache of downloaded GRIB byte ranges (e.g. /tmp/wx_range_cache). Disabled if empty or the size is 0.
+    INGEST_RANGE_CACHE_DIR = os.environ.get('INGEST_RANGE_CACHE_DIR', '')
+    INGEST_RANGE_CACHE_SIZE = int(os.environ.get('INGEST_RANGE_CACHE_SIZE', 4 * 1024 * 1024 * 1024))
+    # Latest full grids of ingested fields, read by grid-wide jobs (blends etc), e.g. /tmp/wx_grids. Must be
+    # shared by all ingest workers and those jobs. Disabled if empty.
+    INGEST_GRID_DIR = os.environ.get('INGEST_GRID_DIR', '')
+    # Short name of the model whose grid the blend (see ingest/blend.py) is on. If empty (or the model doesn't
+    # have a metric), each metric is blended on the grid covering the most of the globe.
+    INGEST_BLEND_GRID = os.environ.get('INGEST_BLEND_GRID', '')
+    # Nowcast frames (see ingest/nowcast.py) are only made for this many hours after each run time. Each
+    # frame is a full grid, so this is off (0) by default.
+    INGEST_NOWCAST_HOURS = int(os.environ.get('INGEST_NOWCAST_HOURS', 0))
     SENTRY_ENDPOINT = os.environ.get('SENTRY_ENDPOINT', None)
 
 Config.SQLALCHEMY_DATABASE_URI = f"postgresql://{Config.POSTGRES_USER}:{Config.POSTGRES_PASS}@{Config.POSTGRES_HOST}:{Config.POSTGRES_PORT}/{Config.POSTGRES_DB}"
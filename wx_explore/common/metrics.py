@@ -2,69 +2,79 @@ from wx_explore.common.models import Metric
 from wx_explore.common.db_utils import get_or_create
 from wx_explore.web.core import app
 
+# Map of metric name -> the units it's declared with below. get_or_create matches on name only, so databases
+# created before a metric's units changed keep the old ones until wx_explore.common.migrate updates them.
+DECLARED_UNITS = {}
+
+
+def _metric(**kwargs) -> Metric:
+    DECLARED_UNITS[kwargs['name']] = kwargs['units']
+    return get_or_create(Metric(**kwargs))
+
+
 with app.app_context():
-    temp = get_or_create(Metric(
+    temp = _metric(
         name='2m Temperature',
-        units='K',
-    ))
-    visibility = get_or_create(Metric(
+        units='C',
+    )
+    visibility = _metric(
         name='Visibility',
         units='m',
-    ))
-    raining = get_or_create(Metric(
+    )
+    raining = _metric(
         name='Rain',
         units='',
-    ))
-    ice = get_or_create(Metric(
+    )
+    ice = _metric(
         name='Ice',
         units='',
-    ))
-    freezing_rain = get_or_create(Metric(
+    )
+    freezing_rain = _metric(
         name='Freezing Rain',
         units='',
-    ))
-    snowing = get_or_create(Metric(
+    )
+    snowing = _metric(
         name='Snow',
         units='',
-    ))
-    composite_reflectivity = get_or_create(Metric(
+    )
+    composite_reflectivity = _metric(
         name='Composite Reflectivity',
         units='dbZ',
-    ))
-    humidity = get_or_create(Metric(
+    )
+    humidity = _metric(
         name='2m Humidity',
         units='kg/kg',
-    ))
-    pressure = get_or_create(Metric(
+    )
+    pressure = _metric(
         name='Surface Pressure',
         units='Pa',
-    ))
-    wind_u = get_or_create(Metric(
+    )
+    wind_u = _metric(
         name='10m Wind U-component',
         units='m/s',
         intermediate=True,
-    ))
-    wind_v = get_or_create(Metric(
+    )
+    wind_v = _metric(
         name='10m Wind V-component',
-        units='deg',
+        units='m/s',
         intermediate=True,
-    ))
-    wind_speed = get_or_create(Metric(
+    )
+    wind_speed = _metric(
         name='10m Wind Speed',
         units='m/s',
-    ))
-    wind_direction = get_or_create(Metric(
+    )
+    wind_direction = _metric(
         name='10m Wind Direction',
         units='deg',
-    ))
-    gust_speed = get_or_create(Metric(
+    )
+    gust_speed = _metric(
         name='Gust Speed',
         units='m/s',
-    ))
-    cloud_cover = get_or_create(Metric(
+    )
+    cloud_cover = _metric(
         name='Cloud Cover',
         units='%',
-    ))
+    )
 
 ALL_METRICS = [
     temp,
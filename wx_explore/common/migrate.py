@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Brings an existing database up to date with the current models. db.create_all() (run on import of
+wx_explore.web.core) only creates missing tables, so anything else is done by the steps here. Every step
+is idempotent, so this is safe to run on every deploy (seed runs it too).
+"""
+import logging
+import os
+import shutil
+
+from wx_explore.common import metrics, storage
+from wx_explore.common.models import IngestManifest, Metric, SourceField
+from wx_explore.common.task_queue import pq
+from wx_explore.ingest.grid_store import get_grid_store
+from wx_explore.ingest.units import get_conversion
+from wx_explore.web.core import app, db
+
+logger = logging.getLogger(__name__)
+
+
+def create_ingest_manifest():
+    IngestManifest.__table__.create(db.engine, checkfirst=True)
+
+
+def create_queue_lease_column():
+    # Queue workers lease the items they dequeue (see task_queue.PriorityQueue)
+    pq[''].create_lease_column()
+
+
+def update_metric_units():
+    """
+    Updates metrics whose declared units changed. Ingest refuses to run until this has (see units.metric_units).
+    Points already stored for such metrics are converted to the new units, and the grid store's copies are
+    dropped (along with the blend/daily state) so the grid-wide jobs don't mix the two.
+    """
+    grid_store = get_grid_store()
+
+    for metric in Metric.query.all():
+        declared = metrics.DECLARED_UNITS.get(metric.name)
+        if declared is None or metric.units == declared:
+            continue
+
+        field_ids = [sf.id for sf in SourceField.query.filter_by(metric_id=metric.id).all()]
+
+        conversion = get_conversion(metric.units, declared)
+        if conversion is not None:
+            logger.info("Converting stored points of %s from %s to %s", metric.name, metric.units, declared)
+            storage.get_provider().convert_fields(field_ids, *conversion)
+        else:
+            logger.warning("No conversion from %s to %s, leaving stored points of %s as they are",
+                           metric.units, declared, metric.name)
+
+        if grid_store is not None:
+            for field_id in field_ids:
+                shutil.rmtree(os.path.join(grid_store.root, str(field_id)), ignore_errors=True)
+            for state in ('blend_state.json', 'daily_state.json'):
+                try:
+                    os.remove(os.path.join(grid_store.root, state))
+                except FileNotFoundError:
+                    pass
+
+        # Committed per metric, so a rerun after a failure doesn't convert points of finished metrics again
+        metric.units = declared
+        db.session.commit()
+
+
+MIGRATIONS = [
+    create_ingest_manifest,
+    create_queue_lease_column,
+    update_metric_units,
+]
+
+
+def migrate():
+    with app.app_context():
+        for step in MIGRATIONS:
+            logger.info("Running migration %s", step.__name__)
+            step()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
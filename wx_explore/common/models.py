@@ -4,6 +4,7 @@ from shapely import wkb
 from sqlalchemy import (
     Column,
     Integer, BigInteger,
+    Float,
     String,
     Boolean,
     DateTime,
@@ -19,6 +20,8 @@ import datetime
 import numpy
 import statistics
 
+from wx_explore.common.utils import datetime2unix, unix2datetime
+
 
 Base = declarative_base()
 
@@ -211,6 +214,36 @@ class FileBandMeta(Base):
     source_field = relationship('SourceField', lazy='joined')
 
 
+class IngestManifest(Base):
+    """
+    Table that records which fields of a given (source, run, valid time) have already been ingested,
+    so that duplicate queue items can be skipped.
+    """
+    __tablename__ = "ingest_manifest"
+
+    source_id = Column(Integer, ForeignKey('source.id'), primary_key=True)
+    run_time = Column(DateTime, primary_key=True)
+    valid_time = Column(DateTime, primary_key=True)
+    source_field_ids = Column(JSONB, nullable=False)  # sorted list of SourceField ids that were stored
+    ingested_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    source = relationship('Source')
+
+
+class PublishDelay(Base):
+    """
+    Table that holds how long after its run time a given forecast hour of a source is typically published.
+    """
+    __tablename__ = "publish_delay"
+
+    source_id = Column(Integer, ForeignKey('source.id'), primary_key=True)
+    forecast_hour = Column(Integer, primary_key=True)
+    delay = Column(Float, nullable=False)  # seconds, exponential moving average of observed delays
+    n_observations = Column(Integer, nullable=False, default=1)
+
+    source = relationship('Source')
+
+
 class DataPointSet(object):
     """
     Non-db object which holds values and metadata for given data point (loc, time)
@@ -266,3 +299,233 @@ class DataPointSet(object):
         vals = numpy.array(self.values)
         n_within_stddev = (abs(vals - self.mean()) < numpy.std(vals)).sum()
         return n_within_stddev / len(vals)
+
+
+class DataPointSetView(DataPointSet):
+    """
+    DataPointSet backed by one point of a DataPointBatch. Fields are read from the batch's arrays on access.
+    """
+    def __init__(self, batch: 'DataPointBatch', i: int):
+        self._batch = batch
+        self._i = i
+        self._values = None
+
+    @property
+    def values(self) -> List[float]:
+        if self._values is None:
+            self._values = self._batch.point_values(self._i).tolist()
+        return self._values
+
+    @property
+    def metric_id(self) -> int:
+        return int(self._batch.metric_id[self._i])
+
+    @property
+    def valid_time(self) -> datetime.datetime:
+        return unix2datetime(self._batch.valid_time[self._i])
+
+    @property
+    def source_field_id(self) -> Optional[int]:
+        sfid = int(self._batch.source_field_id[self._i])
+        return sfid if sfid != DataPointBatch.NO_FIELD else None
+
+    @property
+    def run_time(self) -> Optional[datetime.datetime]:
+        run_time = self._batch.run_time[self._i]
+        return unix2datetime(run_time) if run_time != DataPointBatch.NO_TIME else None
+
+    @property
+    def derived(self) -> bool:
+        return bool(self._batch.derived[self._i])
+
+    @property
+    def synthesized(self) -> bool:
+        return bool(self._batch.synthesized[self._i])
+
+
+class DataPointBatch(object):
+    """
+    Columnar (NumPy backed) set of data points, with one entry per point in each array. The values (members)
+    of point i are values[offsets[i]:offsets[i+1]]. Times are unix timestamps.
+    Iterating (or indexing) gives DataPointSet views of the points.
+    """
+    NO_FIELD = -1
+    NO_TIME = numpy.iinfo(numpy.int64).min
+
+    metric_id: numpy.ndarray  # int32
+    source_field_id: numpy.ndarray  # int32, NO_FIELD if none
+    valid_time: numpy.ndarray  # int64
+    run_time: numpy.ndarray  # int64, NO_TIME if none
+    derived: numpy.ndarray  # bool
+    synthesized: numpy.ndarray  # bool
+    offsets: numpy.ndarray  # int64, one more than the number of points
+    values: numpy.ndarray  # float32
+
+    def __init__(self, metric_id, source_field_id, valid_time, run_time, offsets, values, derived=None, synthesized=None):
+        self.metric_id = numpy.asarray(metric_id, dtype=numpy.int32)
+        self.source_field_id = numpy.asarray(source_field_id, dtype=numpy.int32)
+        self.valid_time = numpy.asarray(valid_time, dtype=numpy.int64)
+        self.run_time = numpy.asarray(run_time, dtype=numpy.int64)
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        self.values = numpy.asarray(values, dtype=numpy.float32)
+        self.derived = numpy.zeros(len(self.metric_id), dtype=bool) if derived is None else numpy.asarray(derived, dtype=bool)
+        self.synthesized = numpy.zeros(len(self.metric_id), dtype=bool) if synthesized is None else numpy.asarray(synthesized, dtype=bool)
+
+    def __repr__(self):
+        return f"<DataPointBatch n_points={len(self)} n_values={len(self.values)}>"
+
+    def __len__(self):
+        return len(self.metric_id)
+
+    def __getitem__(self, i) -> DataPointSet:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return DataPointSetView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield DataPointSetView(self, i)
+
+    def __add__(self, other):
+        return DataPointBatch.concat([self, DataPointBatch.of(other)])
+
+    def __radd__(self, other):
+        return DataPointBatch.concat([DataPointBatch.of(other), self])
+
+    @property
+    def counts(self) -> numpy.ndarray:
+        """
+        :return: Number of values of each point
+        """
+        return numpy.diff(self.offsets)
+
+    def point_values(self, i) -> numpy.ndarray:
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def medians(self) -> numpy.ndarray:
+        """
+        :return: Median of the values of each point, ignoring NaNs (NaN for points without any, e.g. masked cells)
+        """
+        point = numpy.repeat(numpy.arange(len(self)), self.counts)
+        # Sort values within each point. NaNs sort last, so each point's other values come first.
+        sorted_values = self.values[numpy.lexsort((self.values, point))].astype(numpy.float64)
+        counts = numpy.bincount(point[~numpy.isnan(self.values)], minlength=len(self))
+
+        medians = numpy.full(len(self), numpy.nan)
+        has_values = counts > 0
+        starts = self.offsets[:-1][has_values]
+        lo = sorted_values[starts + (counts[has_values] - 1) // 2]
+        hi = sorted_values[starts + counts[has_values] // 2]
+        medians[has_values] = (lo + hi) / 2
+        return medians
+
+    def take(self, idx) -> 'DataPointBatch':
+        """
+        :return: Batch of the points at idx (indices or a boolean mask), in that order
+        """
+        idx = numpy.arange(len(self))[idx]
+        counts = self.counts[idx]
+        offsets = numpy.zeros(len(idx) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        # Index of every value of the taken points
+        value_idx = numpy.repeat(self.offsets[idx] - offsets[:-1], counts) + numpy.arange(offsets[-1])
+        return DataPointBatch(
+            self.metric_id[idx],
+            self.source_field_id[idx],
+            self.valid_time[idx],
+            self.run_time[idx],
+            offsets,
+            self.values[value_idx],
+            self.derived[idx],
+            self.synthesized[idx],
+        )
+
+    @classmethod
+    def empty(cls) -> 'DataPointBatch':
+        return cls([], [], [], [], [0], [])
+
+    @classmethod
+    def concat(cls, batches: List['DataPointBatch']) -> 'DataPointBatch':
+        batches = [b for b in batches if len(b)]
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+
+        value_starts = numpy.cumsum([0] + [len(b.values) for b in batches[:-1]])
+        return cls(
+            numpy.concatenate([b.metric_id for b in batches]),
+            numpy.concatenate([b.source_field_id for b in batches]),
+            numpy.concatenate([b.valid_time for b in batches]),
+            numpy.concatenate([b.run_time for b in batches]),
+            numpy.concatenate([[0]] + [b.offsets[1:] + start for b, start in zip(batches, value_starts)]),
+            numpy.concatenate([b.values for b in batches]),
+            numpy.concatenate([b.derived for b in batches]),
+            numpy.concatenate([b.synthesized for b in batches]),
+        )
+
+    @classmethod
+    def of(cls, data_points) -> 'DataPointBatch':
+        """
+        :return: data_points (an iterable of DataPointSet) as a batch (or data_points itself if it already is one)
+        """
+        if isinstance(data_points, DataPointBatch):
+            return data_points
+
+        builder = DataPointBatchBuilder()
+        for dp in data_points:
+            builder.append(dp.values, dp.metric_id, dp.valid_time, dp.source_field_id, dp.run_time, dp.derived, dp.synthesized)
+        return builder.build()
+
+
+class DataPointBatchBuilder(object):
+    """
+    Accumulates data points (e.g. as a storage backend reads them) into a DataPointBatch.
+    """
+    def __init__(self):
+        self.metric_id = []
+        self.source_field_id = []
+        self.valid_time = []
+        self.run_time = []
+        self.derived = []
+        self.synthesized = []
+        self.counts = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.metric_id)
+
+    def append(
+            self,
+            values,
+            metric_id: int,
+            valid_time: datetime.datetime,
+            source_field_id: Optional[int] = None,
+            run_time: Optional[datetime.datetime] = None,
+            derived: bool = False,
+            synthesized: bool = False):
+        values = numpy.asarray(values, dtype=numpy.float32)
+        self.metric_id.append(metric_id)
+        self.source_field_id.append(source_field_id if source_field_id is not None else DataPointBatch.NO_FIELD)
+        self.valid_time.append(datetime2unix(valid_time))
+        self.run_time.append(datetime2unix(run_time) if run_time is not None else DataPointBatch.NO_TIME)
+        self.derived.append(derived)
+        self.synthesized.append(synthesized)
+        self.counts.append(len(values))
+        self.values.append(values)
+
+    def build(self) -> DataPointBatch:
+        offsets = numpy.zeros(len(self.counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.counts, out=offsets[1:])
+        return DataPointBatch(
+            self.metric_id,
+            self.source_field_id,
+            self.valid_time,
+            self.run_time,
+            offsets,
+            numpy.concatenate(self.values) if self.values else [],
+            self.derived,
+            self.synthesized,
+        )
@@ -12,10 +12,13 @@ from wx_explore.common.models import (
 
 from wx_explore.common import metrics
 from wx_explore.common.db_utils import get_or_create
+from wx_explore.common.migrate import migrate
 from wx_explore.web.core import app, db
 
 
 def seed():
+    migrate()
+
     with app.app_context():
         sources = [
             Source(
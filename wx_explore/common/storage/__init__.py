@@ -3,14 +3,17 @@ from typing import Tuple, Optional, Iterable, Dict, List
 import concurrent.futures
 import datetime
 import numpy
+import struct
+import zlib
 
 from wx_explore.common import tracing
 from wx_explore.common.config import Config
 from wx_explore.common.location import get_xy_for_coord
 from wx_explore.common.models import (
+    Source,
     SourceField,
     Projection,
-    DataPointSet,
+    DataPointBatch,
 )
 
 
@@ -22,7 +25,7 @@ class DataProvider(object):
             valid_source_fields: List[SourceField],
             start: datetime.datetime,
             end: datetime.datetime
-    ) -> List[DataPointSet]:
+    ) -> DataPointBatch:
         raise NotImplementedError()
 
     def put_fields(
@@ -35,11 +38,75 @@ class DataProvider(object):
     def clean(self, oldest_time: datetime.datetime):
         raise NotImplementedError()
 
+    def convert_fields(self, field_ids: List[int], scale: float, offset: float):
+        """
+        Converts the stored values of the given fields to value * scale + offset, e.g. when their metric's
+        units change. Only values stored before fields were normalized to their metric's units are converted.
+        """
+        raise NotImplementedError()
+
     def merge(self):
         raise NotImplementedError()
 
 
-def get_provider():
+# Header prepended to every packed member block: a magic marking the layout, then the little-endian uint32
+# member count. Blocks written before members were packed are a bare float32 row, so have no header.
+MEMBER_MAGIC = b'WXM1'
+MEMBER_HEADER = struct.Struct('<4sI')
+
+
+def pack_members(msgs: List[numpy.array], y: int, x: int, n_x: int) -> bytes:
+    """
+    Pack row y, columns [x, x+n_x) of every member in msgs into a single zlib'd
+    [member x n_x] float32 block prefixed with MEMBER_HEADER.
+    """
+    block = numpy.stack([msg[y][x:x+n_x] for msg in msgs]).astype(numpy.float32)
+    return zlib.compress(MEMBER_HEADER.pack(MEMBER_MAGIC, len(msgs)) + block.tobytes())
+
+
+def unpack_member_values(packed: bytes, rel_x: int) -> numpy.ndarray:
+    """
+    Inverse of pack_members, returning the value of every member at column rel_x of the block.
+    Header-less blocks (from before members were packed) are read as a single member.
+    """
+    raw = zlib.decompress(packed)
+    if raw[:len(MEMBER_MAGIC)] != MEMBER_MAGIC:
+        return numpy.frombuffer(raw, dtype=numpy.float32)[rel_x:rel_x+1]
+
+    _, n_members = MEMBER_HEADER.unpack_from(raw)
+    block = numpy.frombuffer(raw, dtype=numpy.float32, offset=MEMBER_HEADER.size).reshape((n_members, -1))
+    return block[:, rel_x]
+
+
+def convert_header_less(packed: bytes, scale: float, offset: float) -> Optional[bytes]:
+    """
+    Converts the values of a header-less block to value * scale + offset, returning them packed as pack_members
+    does, or None if the block has a header. Header-less blocks were stored as their GRIB had them, while blocks
+    with a header were normalized to their metric's units (see ingest.units) so never need converting.
+    """
+    raw = zlib.decompress(packed)
+    if raw[:len(MEMBER_MAGIC)] == MEMBER_MAGIC:
+        return None
+
+    values = numpy.frombuffer(raw, dtype=numpy.float32) * numpy.float32(scale) + numpy.float32(offset)
+    return zlib.compress(MEMBER_HEADER.pack(MEMBER_MAGIC, 1) + values.astype(numpy.float32).tobytes())
+
+
+_provider: Optional[DataProvider] = None
+
+
+def get_provider() -> DataProvider:
+    """
+    Returns the configured DataProvider. The provider is created once per process so that
+    clients, connection pools, and executors it holds are reused across calls.
+    """
+    global _provider
+    if _provider is None:
+        _provider = _create_provider()
+    return _provider
+
+
+def _create_provider() -> DataProvider:
     from .s3 import S3Backend
     from .azure_tables import AzureTableBackend
     from .mongo import MongoBackend
@@ -57,6 +124,7 @@ def get_provider():
             Config.INGEST_AZURE_TABLE_ACCOUNT_NAME,
             Config.INGEST_AZURE_TABLE_ACCOUNT_KEY,
             Config.INGEST_AZURE_TABLE_NAME,
+            Config.INGEST_AZURE_TABLE_CONNECTION_STRING,
         )
     elif Config.DATA_PROVIDER == "MONGO":
         return MongoBackend(
@@ -65,19 +133,74 @@ def get_provider():
             Config.INGEST_MONGO_COLLECTION,
         )
 
+    raise ValueError(f"Unknown data provider {Config.DATA_PROVIDER}")
+
+
+# Hourly rollups of sub-hourly sources (see wx_explore.ingest.rollup) are stored as synthesized sources,
+# one per statistic, named by suffixing the source's short name
+ROLLUP_STATS = {
+    'mean': '1h',
+    'min': '1hn',
+    'max': '1hx',
+}
+
+
+def rollup_source_name(short_name: str, stat: str) -> str:
+    return short_name + ROLLUP_STATS[stat]
+
+
+def select_rollup_fields(source_fields: Iterable[SourceField], rollup: Optional[str]) -> List[SourceField]:
+    """
+    Drops rollup fields from source_fields, then (if rollup is given) swaps every field which has an hourly rollup
+    for its rollup field of that statistic.
+    """
+    source_fields = list(source_fields)
+    source_names = {sf.source.short_name for sf in source_fields if sf.selectors is not None}
+    rollup_names = {rollup_source_name(name, stat) for name in source_names for stat in ROLLUP_STATS}
+
+    source_fields = [sf for sf in source_fields if sf.source.short_name not in rollup_names]
+    if rollup is None or not source_names:
+        return source_fields
+
+    # Rollup fields are of the same metric as the field they roll up, in the rollup source of its source
+    rollup_fields = {
+        (sf.source.short_name, sf.metric_id): sf
+        for sf in SourceField.query.filter(
+            SourceField.source.has(Source.short_name.in_([rollup_source_name(name, rollup) for name in source_names])),
+            SourceField.projection_id != None,  # noqa: E711
+        ).all()
+    }
+    # Map of field id -> its rollup field
+    rollup_by_field = {}
+    for sf in source_fields:
+        if sf.selectors is None:
+            continue
+        rollup_sf = rollup_fields.get((rollup_source_name(sf.source.short_name, rollup), sf.metric_id))
+        if rollup_sf is not None:
+            rollup_by_field[sf.id] = rollup_sf
+
+    return [rollup_by_field.get(sf.id, sf) for sf in source_fields]
+
 
 def load_data_points(
         coords: Tuple[float, float],
         start: datetime.datetime,
         end: datetime.datetime,
-        source_fields: Optional[Iterable[SourceField]] = None
-) -> List[DataPointSet]:
+        source_fields: Optional[Iterable[SourceField]] = None,
+        rollup: Optional[str] = None,
+) -> DataPointBatch:
+    """
+    :param rollup: If given, read the hourly rollup (of this statistic, see ROLLUP_STATS) of fields which have one
+                   in place of their sub-hourly data
+    """
     
     print(coords, start, end, source_fields)
 
     if source_fields is None or source_fields == []:
         source_fields = SourceField.query.all()
 
+    source_fields = select_rollup_fields(source_fields, rollup)
+
     # Determine all valid source fields (fields in source_fields which cover the given coords),
     # and the x,y for projection used in any valid source field.
     valid_source_fields = []
@@ -104,13 +227,15 @@ def load_data_points(
 
         valid_source_fields.append(sf)
 
+    if not locs:
+        return DataPointBatch.empty()
+
     with concurrent.futures.ThreadPoolExecutor(max_workers=len(locs)) as ex:
-        data_points: List[DataPointSet] = sum(
+        data_points = DataPointBatch.concat(list(
             ex.map(
                 lambda proj_loc: get_provider().get_fields(*proj_loc, valid_source_fields, start, end),
                 locs.items()
-            ),
-            [],
-        )
+            )
+        ))
 
     return data_points
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Round-trips a few small grids through AzureTableBackend.put_fields/get_fields, then times it against the
+previous client handling (a new TableService per call) and fixed 3 hour slices. Runs against the Azurite
+emulator (see docker-compose.dev.yaml) by default or whatever INGEST_AZURE_TABLE_CONNECTION_STRING points at.
+"""
+from datetime import datetime, timedelta, timezone
+
+import argparse
+import logging
+import numpy
+import time
+import uuid
+
+from azure.cosmosdb.table.tableservice import TableService
+
+from wx_explore.common.config import Config
+from wx_explore.common.models import Projection, SourceField
+from wx_explore.common.storage.azure_tables import AzureTableBackend
+
+AZURITE_CONNECTION_STRING = (
+    'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+    'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;'
+    'TableEndpoint=http://localhost:10002/devstoreaccount1;'
+)
+
+
+class PerCallClientBackend(AzureTableBackend):
+    """
+    AzureTableBackend with the previous client handling: a new TableService (and so connection) every time
+    one is used, i.e. per slice scan, put batch and cleaned row.
+    """
+
+    def __init__(self, account_name, account_key, table_name, connection_string=None):
+        self.connection_string = connection_string
+        super().__init__(account_name, account_key, table_name, connection_string)
+
+    @property
+    def svc(self) -> TableService:
+        if self.connection_string is not None:
+            return TableService(connection_string=self.connection_string)
+        return TableService(self.account_name, self.account_key)
+
+    @svc.setter
+    def svc(self, svc: TableService):
+        # The pooled service made by AzureTableBackend is unused
+        pass
+
+
+class FixedSliceBackend(AzureTableBackend):
+    """
+    AzureTableBackend with the previous time slicing: 3 hours per slice regardless of how many rows it holds.
+    """
+
+    def _slice_hours(self) -> float:
+        return 3
+
+
+class PreviousBackend(PerCallClientBackend, FixedSliceBackend):
+    pass
+
+
+def check_round_trip(backend: AzureTableBackend):
+    # Wider than one row shard so reads have to pick the right one
+    proj = Projection(id=1, n_x=backend.n_x_per_row + 10, n_y=3)
+    fields = [SourceField(id=1, metric_id=1), SourceField(id=2, metric_id=2)]
+
+    run_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    valid_times = [run_time + timedelta(hours=h) for h in range(6)]
+
+    rng = numpy.random.default_rng(0)
+    expected = {}
+    to_put = {}
+    for sf in fields:
+        # The second field has two members, as ensembles do
+        n_members = sf.id
+        for valid_time in valid_times:
+            msgs = [rng.random((proj.n_y, proj.n_x), dtype=numpy.float32) for _ in range(n_members)]
+            to_put[(sf.id, valid_time, run_time)] = msgs
+            expected[(sf.id, valid_time)] = msgs
+
+    backend.put_fields(proj, to_put)
+
+    for x, y in [(0, 0), (proj.n_x - 1, 2), (backend.n_x_per_row + 3, 1)]:
+        batch = backend.get_fields(proj.id, (x, y), fields, valid_times[0] - timedelta(minutes=1), valid_times[-1] + timedelta(minutes=1))
+        assert len(batch) == len(expected), f"Expected {len(expected)} points at {(x, y)}, got {len(batch)}"
+
+        for dp in batch:
+            valid_time = dp.valid_time.astimezone(timezone.utc).replace(tzinfo=None)
+            msgs = expected[(dp.source_field_id, valid_time)]
+            assert dp.metric_id == fields[dp.source_field_id - 1].metric_id
+            assert dp.run_time.astimezone(timezone.utc).replace(tzinfo=None) == run_time
+            assert list(dp.values) == [msg[y][x] for msg in msgs], f"Values differ for {dp}"
+
+        logging.info("%d points at %s match", len(batch), (x, y))
+
+
+def timed(func, *args, repeat=5) -> float:
+    """
+    :return: Best time (seconds) of repeat calls of func
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(connection_string: str, table_name: str, hours: int, repeat: int):
+    """
+    Times put_fields and a get_fields of every hour of a forecast as long as GFS's, with each variant of the backend.
+    """
+    backends = {
+        'per-call clients, fixed slices (previous)': PreviousBackend(None, None, table_name, connection_string),
+        'pooled client, fixed slices': FixedSliceBackend(None, None, table_name, connection_string),
+        'pooled client, adaptive slices': AzureTableBackend(None, None, table_name, connection_string=connection_string),
+    }
+
+    # A projection of its own, so the round trip's rows aren't read
+    proj = Projection(id=2, n_x=backends['pooled client, adaptive slices'].n_x_per_row, n_y=4)
+    fields = [SourceField(id=3, metric_id=1), SourceField(id=4, metric_id=2)]
+
+    run_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    valid_times = [run_time + timedelta(hours=h) for h in range(hours)]
+    start, end = valid_times[0] - timedelta(minutes=1), valid_times[-1] + timedelta(minutes=1)
+
+    rng = numpy.random.default_rng(0)
+    to_put = {
+        (sf.id, valid_time, run_time): [rng.random((proj.n_y, proj.n_x), dtype=numpy.float32)]
+        for sf in fields
+        for valid_time in valid_times
+    }
+
+    print(f"{len(to_put)} fields of {proj.n_y}x{proj.n_x} over {hours} hours")
+    for name, backend in backends.items():
+        print(f"put_fields, {name}: {timed(backend.put_fields, proj, to_put, repeat=repeat) * 1000:.2f} ms")
+
+    for name, backend in backends.items():
+        # Once first, so the adaptive backend has learned the rows per hour
+        backend.get_fields(proj.id, (0, 0), fields, start, end)
+        print(f"get_fields ({backend._slice_hours():g}h slices), {name}: "
+              f"{timed(backend.get_fields, proj.id, (0, 0), fields, start, end, repeat=repeat) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Check and benchmark an Azure Table Storage round trip (e.g. against Azurite)')
+    parser.add_argument('--connection-string', default=Config.INGEST_AZURE_TABLE_CONNECTION_STRING or AZURITE_CONNECTION_STRING)
+    parser.add_argument('--hours', type=int, default=240, help='Number of hourly valid times to benchmark with')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each variant (the best is reported)')
+    parser.add_argument('--no-benchmark', action='store_true', help='Only check the round trip')
+    args = parser.parse_args()
+
+    # A throwaway table, so the check can't clobber real data
+    table_name = 'wxcheck' + uuid.uuid4().hex[:8]
+    backend = AzureTableBackend(None, None, table_name, connection_string=args.connection_string)
+    backend.svc.create_table(table_name)
+    try:
+        check_round_trip(backend)
+        print("OK")
+
+        if not args.no_benchmark:
+            benchmark(args.connection_string, table_name, args.hours, args.repeat)
+    finally:
+        backend.svc.delete_table(table_name)
@@ -5,20 +5,21 @@ from azure.cosmosdb.table import (
     EdmType,
     TableBatch,
 )
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
 
-import array
 import concurrent.futures
 import datetime
 import logging
 import numpy
-import zlib
+import requests
+import threading
 
-from . import DataProvider
+from . import DataProvider, convert_header_less, pack_members, unpack_member_values
 from wx_explore.common.models import (
     Projection,
     SourceField,
-    DataPointSet,
+    DataPointBatch,
+    DataPointBatchBuilder,
 )
 from wx_explore.common.utils import chunk
 
@@ -33,22 +34,33 @@ class AzureTableBackend(DataProvider):
     We use the following:
         * pk is (proj_id, y)
         * row is (valid_time, run_time, x_shard)
-        * properties are "sf{n}" -> zlib'd bytearr value for each x in the shard
+        * properties are "sf{n}" -> zlib'd member count + [member x x] float32 block for the x shard
 
     This means:
         * Location queries are always on a single partition
         * Valid time based filtering (less than, greater than) via lexicographical compares on row
         * Minimal amount of data sent back since any given row in storage is only n_x_per_row dwords
-        * X sharding also means we can store ensemble results in a single property (TODO)
+        * X sharding also means we can store ensemble results in a single property
     """
 
     logger: logging.Logger
     account_name: str
     account_key: str
     table_name: str
+    svc: TableService
+    executor: concurrent.futures.ThreadPoolExecutor
     n_x_per_row: int = 128
+    n_workers: int = 16
 
-    def __init__(self, account_name, account_key, table_name):
+    # Time slicing for location queries. Each slice is one parallel partition scan, and slices are
+    # sized from the observed number of rows per hour so each scan returns about target_rows_per_slice
+    # rows (ATS returns at most 1000 entities per page).
+    target_rows_per_slice: int = 500
+    min_slice_hours: float = 1
+    max_slice_hours: float = 48
+    rows_per_hour: Optional[float] = None
+
+    def __init__(self, account_name, account_key, table_name, connection_string=None):
         logging.getLogger('azure').setLevel(logging.WARNING)
         logging.getLogger('urllib3').setLevel(logging.ERROR)
 
@@ -57,6 +69,38 @@ class AzureTableBackend(DataProvider):
         self.account_key = account_key
         self.table_name = table_name
 
+        # One keep-alive session (and client) shared by every worker thread,
+        # with enough pooled connections that no worker has to open its own.
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.n_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if connection_string is not None:
+            self.svc = TableService(connection_string=connection_string, request_session=session)
+        else:
+            self.svc = TableService(account_name, account_key, request_session=session)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers)
+        # Guards rows_per_hour, which every slice worker updates
+        self.rows_per_hour_lock = threading.Lock()
+
+    def _slice_hours(self) -> float:
+        if self.rows_per_hour is None:
+            return 3
+        if self.rows_per_hour <= 0:
+            return self.max_slice_hours
+        return min(max(self.target_rows_per_slice / self.rows_per_hour, self.min_slice_hours), self.max_slice_hours)
+
+    def _observe_slice(self, n_rows: int, hours: float):
+        # Exponentially weighted so a few sparse/dense slices don't swing the slice size around
+        observed = n_rows / hours
+        with self.rows_per_hour_lock:
+            if self.rows_per_hour is None:
+                self.rows_per_hour = observed
+            else:
+                self.rows_per_hour = 0.8 * self.rows_per_hour + 0.2 * observed
+
     def get_fields(
             self,
             proj_id: int,
@@ -64,25 +108,23 @@ class AzureTableBackend(DataProvider):
             valid_source_fields: List[SourceField],
             start: datetime.datetime,
             end: datetime.datetime
-    ) -> List[DataPointSet]:
+    ) -> DataPointBatch:
         start = start.replace(microsecond=0)
         end = end.replace(microsecond=0)
 
-        parallel_hours = 3
+        slice_len = datetime.timedelta(hours=self._slice_hours())
 
         times = [start]
-        while times[-1] + datetime.timedelta(hours=parallel_hours) < end:
-            times.append(times[-1] + datetime.timedelta(hours=parallel_hours))
+        while times[-1] + slice_len < end:
+            times.append((times[-1] + slice_len).replace(microsecond=0))
         times.append(end)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(times)-1) as ex:
-            return sum(
-                ex.map(
-                    lambda time_range: self._get_fields_worker(proj_id, loc, valid_source_fields, *time_range),
-                    zip(times[:-1], times[1:]),
-                ),
-                [],
+        return DataPointBatch.concat(list(
+            self.executor.map(
+                lambda time_range: self._get_fields_worker(proj_id, loc, valid_source_fields, *time_range),
+                zip(times[:-1], times[1:]),
             )
+        ))
 
     def _get_fields_worker(
             self,
@@ -91,7 +133,7 @@ class AzureTableBackend(DataProvider):
             valid_source_fields: List[SourceField],
             start: datetime.datetime,
             end: datetime.datetime
-    ) -> List[DataPointSet]:
+    ) -> DataPointBatch:
         x, y = loc
         partition = f"{proj_id}-{y}"
 
@@ -105,28 +147,27 @@ class AzureTableBackend(DataProvider):
         az_filter = f"PartitionKey eq '{partition}' and RowKey gt '{row_start}' and RowKey lt '{row_end}' and XShard eq {nearest_row_x}"
         select = ['PartitionKey', 'RowKey', 'ValidTime', 'RunTime', *(f"sf{sf.id}" for sf in valid_source_fields)]
 
-        data_points = []
+        data_points = DataPointBatchBuilder()
+        n_rows = 0
 
-        for row in TableService(self.account_name, self.account_key).query_entities(self.table_name, az_filter, ','.join(select)):
+        for row in self.svc.query_entities(self.table_name, az_filter, ','.join(select)):
+            n_rows += 1
             for sf in valid_source_fields:
                 key = f"sf{sf.id}"
                 if key not in row or row[key] is None:
                     continue
 
-                raw = zlib.decompress(row[key].value)
-                val = array.array("f", raw).tolist()[rel_x]
-
-                data_point = DataPointSet(
-                    values=[val],
-                    metric_id=sf.metric.id,
-                    valid_time=row.ValidTime,
+                data_points.append(
+                    unpack_member_values(row[key].value, rel_x),
+                    sf.metric_id,
+                    row.ValidTime,
                     source_field_id=sf.id,
                     run_time=row.RunTime,
                 )
 
-                data_points.append(data_point)
+        self._observe_slice(n_rows, (end - start).total_seconds() / 3600)
 
-        return data_points
+        return data_points.build()
 
     def put_fields(
             self,
@@ -134,8 +175,7 @@ class AzureTableBackend(DataProvider):
             fields: Dict[Tuple[int, datetime.datetime, datetime.datetime], List[numpy.array]]
     ):
         # fields is map of (field_id, valid_time, run_time) -> [msg, ...]
-        with concurrent.futures.ThreadPoolExecutor() as ex:
-            ex.map(lambda y: self._put_fields_worker(proj, fields, y), range(proj.n_y))
+        list(self.executor.map(lambda y: self._put_fields_worker(proj, fields, y), range(proj.n_y)))
 
     def _put_fields_worker(
             self,
@@ -153,12 +193,11 @@ class AzureTableBackend(DataProvider):
                 if row_key not in rows:
                     rows[row_key] = {}
 
-                for msg in msgs:
-                    # XXX: this only keeps last msg per field breaking ensembles
-                    rows[row_key][f"sf{field_id}"] = EntityProperty(EdmType.BINARY, zlib.compress(msg[y][x:x+self.n_x_per_row].astype(numpy.float32).tobytes()))
+                # All members (e.g. of an ensemble) are kept together in one [member x x] block
+                rows[row_key][f"sf{field_id}"] = EntityProperty(EdmType.BINARY, pack_members(msgs, y, x, self.n_x_per_row))
 
         for row_chunk in chunk(rows.items(), 100):
-            with TableService(self.account_name, self.account_key).batch(self.table_name) as batch:
+            with self.svc.batch(self.table_name) as batch:
                 for row_key, row in row_chunk:
                     valid_time, run_time, x = row_key
                     # Insert or merge here because if two models share projection, there may already be
@@ -179,20 +218,43 @@ class AzureTableBackend(DataProvider):
         earliest = oldest_time.replace(microsecond=0)
 
         for proj in Projection.query.all():
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as ex:
-                ex.map(lambda y: self._clean_worker(earliest, proj, y), range(proj.n_y))
+            list(self.executor.map(lambda y: self._clean_worker(earliest, proj, y), range(proj.n_y)))
 
     def _clean_worker(self, earliest: datetime.datetime, proj: Projection, y: int):
-        svc = TableService(self.account_name, self.account_key)
         to_delete = []
 
-        for row in svc.query_entities(self.table_name, f"PartitionKey eq '{proj.id}-{y}' and RowKey lt '{earliest.isoformat()}'", 'PartitionKey,RowKey'):
+        for row in self.svc.query_entities(self.table_name, f"PartitionKey eq '{proj.id}-{y}' and RowKey lt '{earliest.isoformat()}'", 'PartitionKey,RowKey'):
             to_delete.append((row.PartitionKey, row.RowKey))
 
         for batch_elems in chunk(to_delete, 100):
-            with svc.batch(self.table_name) as batch:
+            with self.svc.batch(self.table_name) as batch:
                 for entity in batch_elems:
                     batch.delete_entity(*entity)
 
+    def convert_fields(self, field_ids: List[int], scale: float, offset: float):
+        for proj in Projection.query.all():
+            list(self.executor.map(lambda y: self._convert_worker(field_ids, scale, offset, proj, y), range(proj.n_y)))
+
+    def _convert_worker(self, field_ids: List[int], scale: float, offset: float, proj: Projection, y: int):
+        keys = [f"sf{field_id}" for field_id in field_ids]
+        to_merge = []
+
+        for row in self.svc.query_entities(self.table_name, f"PartitionKey eq '{proj.id}-{y}'", ','.join(['PartitionKey', 'RowKey', *keys])):
+            converted = {}
+            for key in keys:
+                if key not in row or row[key] is None:
+                    continue
+                packed = convert_header_less(row[key].value, scale, offset)
+                if packed is not None:
+                    converted[key] = EntityProperty(EdmType.BINARY, packed)
+
+            if converted:
+                to_merge.append({'PartitionKey': row.PartitionKey, 'RowKey': row.RowKey, **converted})
+
+        for batch_elems in chunk(to_merge, 100):
+            with self.svc.batch(self.table_name) as batch:
+                for entity in batch_elems:
+                    batch.merge_entity(entity)
+
     def merge(self):
         pass
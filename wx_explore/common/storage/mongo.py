@@ -1,20 +1,19 @@
 from typing import Dict, Tuple, List, Any
 
-import array
 import concurrent.futures
 import datetime
 import logging
 import numpy
 import pymongo
 import pytz
-import zlib
 
-from . import DataProvider
+from . import DataProvider, convert_header_less, pack_members, unpack_member_values
 from wx_explore.common import tracing
 from wx_explore.common.models import (
     Projection,
     SourceField,
-    DataPointSet,
+    DataPointBatch,
+    DataPointBatchBuilder,
 )
 
 
@@ -41,7 +40,7 @@ class MongoBackend(DataProvider):
             valid_source_fields: List[SourceField],
             start: datetime.datetime,
             end: datetime.datetime
-    ) -> List[DataPointSet]:
+    ) -> DataPointBatch:
         x, y = loc
 
         nearest_row_x = ((x // self.n_x_per_row) * self.n_x_per_row)
@@ -58,7 +57,7 @@ class MongoBackend(DataProvider):
                 },
             })
 
-        data_points = []
+        data_points = DataPointBatchBuilder()
 
         for item in results:
             for sf in valid_source_fields:
@@ -66,20 +65,15 @@ class MongoBackend(DataProvider):
                 if key not in item or item[key] is None:
                     continue
 
-                raw = zlib.decompress(item[key])
-                val = array.array("f", raw).tolist()[rel_x]
-
-                data_point = DataPointSet(
-                    values=[val],
-                    metric_id=sf.metric.id,
-                    valid_time=item['valid_time'].replace(tzinfo=pytz.UTC),
+                data_points.append(
+                    unpack_member_values(item[key], rel_x),
+                    sf.metric_id,
+                    item['valid_time'].replace(tzinfo=pytz.UTC),
                     source_field_id=sf.id,
                     run_time=item['run_time'].replace(tzinfo=pytz.UTC),
                 )
 
-                data_points.append(data_point)
-
-        return data_points
+        return data_points.build()
 
     def put_fields(
             self,
@@ -114,9 +108,8 @@ class MongoBackend(DataProvider):
                             'x_shard': x,
                         }
 
-                    for msg in msgs:
-                        # XXX: this only keeps last msg per field breaking ensembles
-                        rows[row_key][f"sf{field_id}"] = zlib.compress(msg[y][x:x+self.n_x_per_row].astype(numpy.float32).tobytes())
+                    # All members (e.g. of an ensemble) are kept together in one [member x x] block
+                    rows[row_key][f"sf{field_id}"] = pack_members(msgs, y, x, self.n_x_per_row)
 
         with tracing.start_span('put_fields saving') as span:
             self.collection.insert_many(rows.values())
@@ -130,5 +123,18 @@ class MongoBackend(DataProvider):
                 },
             })
 
+    def convert_fields(self, field_ids: List[int], scale: float, offset: float):
+        for field_id in field_ids:
+            key = f"sf{field_id}"
+            n_converted = 0
+            for item in self.collection.find({key: {'$exists': True}}, {key: 1}):
+                converted = convert_header_less(item[key], scale, offset)
+                if converted is None:
+                    continue
+                self.collection.update_one({'_id': item['_id']}, {'$set': {key: converted}})
+                n_converted += 1
+
+            self.logger.info("Converted %d rows of %s", n_converted, key)
+
     def merge(self):
         pass
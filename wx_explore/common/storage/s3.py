@@ -3,7 +3,6 @@ from functools import partial
 from math import ceil
 from typing import List, Dict, Tuple
 
-import array
 import boto3
 import collections
 import concurrent.futures
@@ -24,7 +23,8 @@ from wx_explore.common.models import (
     SourceField,
     FileMeta,
     FileBandMeta,
-    DataPointSet,
+    DataPointBatch,
+    DataPointBatchBuilder,
 )
 from wx_explore.common.utils import chunk
 from wx_explore.web.core import db
@@ -117,7 +117,7 @@ class S3Backend(DataProvider):
             valid_source_fields: List[SourceField],
             start: datetime.datetime,
             end: datetime.datetime
-    ) -> List[DataPointSet]:
+    ) -> DataPointBatch:
         with tracing.start_span("load file band metas") as span:
             fbms: List[FileBandMeta] = FileBandMeta.query.filter(
                 FileBandMeta.source_field.has(id=proj_id),
@@ -142,21 +142,18 @@ class S3Backend(DataProvider):
                     file_contents[fm.file_name] = future.result()
 
         # filebandmeta -> values
-        data_points = []
+        data_points = DataPointBatchBuilder()
         for fbm in fbms:
             raw = file_contents[fbm.file_name][fbm.offset:fbm.offset+(4*fbm.vals_per_loc)]
-            data_values: List[float] = array.array("f", raw).tolist()
-            data_point = DataPointSet(
-                values=data_values,
-                metric_id=fbm.source_field.metric.id,
-                valid_time=fbm.valid_time,
+            data_points.append(
+                numpy.frombuffer(raw, dtype=numpy.float32),
+                fbm.source_field.metric_id,
+                fbm.valid_time,
                 source_field_id=fbm.source_field_id,
                 run_time=fbm.run_time,
             )
 
-            data_points.append(data_point)
-
-        return data_points
+        return data_points.build()
 
     def put_fields(
             self,
@@ -245,6 +242,27 @@ class S3Backend(DataProvider):
         for grp in chunk(to_del, 1000):
             s3.delete_objects(Delete={'Objects': [{'Key': key} for key in grp]})
 
+    def convert_fields(self, field_ids: List[int], scale: float, offset: float):
+        # Files don't record the units of their bands, but ingest refuses to store fields whose metric's units
+        # are changing until they've been converted (see ingest.units.metric_units), so every band is converted.
+        bands_by_file = collections.defaultdict(list)
+        for band in FileBandMeta.query.filter(FileBandMeta.source_field_id.in_(field_ids)).all():
+            bands_by_file[band.file_meta].append(band)
+
+        for f, bands in bands_by_file.items():
+            idxs = [i for band in bands for i in range(band.offset // 4, band.offset // 4 + band.vals_per_loc)]
+            n_y, n_x = f.projection.shape()
+
+            self.logger.info("Converting %d bands of file group %s", len(bands), f.file_name)
+            with concurrent.futures.ThreadPoolExecutor(10) as executor:
+                list(executor.map(partial(self._convert_stripe, f, n_x, idxs, scale, offset), range(n_y)))
+
+    def _convert_stripe(self, f, n_x, idxs, scale, offset, y):
+        stripe_req = self._s3_get(f"{y}/{f.file_name}")
+        datas = numpy.frombuffer(stripe_req.content, dtype=numpy.float32).reshape((n_x, f.loc_size//4)).copy()
+        datas[:, idxs] = datas[:, idxs] * numpy.float32(scale) + numpy.float32(offset)
+        self._s3_put(f"{y}/{f.file_name}", datas.tobytes())
+
     ###
     # Merging
     ###
@@ -1,8 +1,104 @@
+from datetime import timedelta
 from psycopg2 import connect, ProgrammingError
-from pq import PQ
+from pq import PQ, Queue
+from pq.utils import prepared
 
 from wx_explore.common.config import Config
 
+# How long a dequeued item is leased to its worker. Workers must extend their leases (heartbeat) more often
+# than this. Items whose lease expires (e.g. their worker crashed) can be dequeued again.
+LEASE = timedelta(minutes=2)
+
+
+class PriorityQueue(Queue):
+    """
+    A pq Queue which dequeues the ready item with the highest "priority" (an int in the item's data, default 0)
+    instead of the one scheduled earliest. When nothing is ready, the next scheduled item is still used to
+    decide how long to wait.
+
+    Dequeued items are leased rather than removed: the worker must extend_leases while working on them and
+    complete them when done, otherwise they are dequeued again once their lease expires.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Prepared statements are formatted with the instance's attributes, so this is what _pull_item leases for
+        self.lease = LEASE
+
+    @prepared
+    def _pull_item(self, cursor, blocking):
+        """Return the highest priority ready item from the queue.
+
+            WITH
+              selected AS (
+                SELECT * FROM %(table)s
+                WHERE
+                  q_name = %(name)s AND
+                  (dequeued_at IS NULL OR lease_until < now())
+                ORDER BY
+                  (schedule_at IS NULL OR schedule_at <= now()) DESC,
+                  CASE WHEN schedule_at IS NULL OR schedule_at <= now()
+                    THEN COALESCE((data->>'priority')::int, 0)
+                    ELSE 0
+                  END DESC,
+                  schedule_at nulls first, expected_at nulls last, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+              ),
+              updated AS (
+                UPDATE %(table)s AS t SET
+                  dequeued_at = current_timestamp,
+                  lease_until = current_timestamp + %(lease)s
+                FROM selected
+                WHERE
+                  t.id = selected.id AND
+                  (t.schedule_at <= now() OR t.schedule_at is NULL)
+                RETURNING t.data, length(t.data::text) AS length
+              )
+            SELECT
+              id,
+              (SELECT data::text FROM updated),
+              (SELECT length FROM updated),
+              enqueued_at AT TIME ZONE 'utc' AS enqueued_at,
+              schedule_at AT TIME ZONE 'utc' AS schedule_at,
+              expected_at AT TIME ZONE 'utc' AS expected_at,
+              (date_part(
+                'second', (
+                  (SELECT schedule_at - now() FROM selected))))
+            FROM selected
+
+        """
+
+        row = cursor.fetchone()
+        if row is None:
+            if blocking:
+                self._listen(cursor)
+
+            return None, None, None, None, None, None, None
+
+        return row
+
+    def extend_leases(self, job_ids):
+        """
+        Heartbeat for items still being worked on.
+        """
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE %s SET lease_until = now() + %s WHERE id = ANY(%s) AND lease_until IS NOT NULL",
+                (self.table, LEASE, list(job_ids)),
+            )
+
+    def complete(self, job_ids):
+        """
+        Removes items which are done being worked on (including ones that were re-queued as new items).
+        """
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM %s WHERE id = ANY(%s)", (self.table, list(job_ids)))
+
+    def create_lease_column(self):
+        with self._transaction() as cursor:
+            cursor.execute("ALTER TABLE %s ADD COLUMN IF NOT EXISTS lease_until timestamptz", (self.table,))
+
 
 pq = PQ(
     connect(
@@ -12,7 +108,8 @@ pq = PQ(
         port=Config.POSTGRES_PORT,
         dbname=Config.POSTGRES_DB,
     ),
-    table='work_queue')
+    table='work_queue',
+    queue_class=PriorityQueue)
 
 try:
     pq.create()
@@ -7,11 +7,15 @@ import functools
 import logging
 import math
 import requests
+import threading
 import time
 
 
 logger = logging.getLogger(__name__)
 
+_session = None
+_session_lock = threading.Lock()
+
 
 def datetime2unix(dt: datetime.datetime) -> int:
     """
@@ -23,19 +27,43 @@ def datetime2unix(dt: datetime.datetime) -> int:
     return int(dt.timestamp())
 
 
-def get_url(url, headers=None, retries=3):
+def unix2datetime(ts: int) -> datetime.datetime:
+    """
+    Inverse of datetime2unix, giving a utc datetime.
+    """
+    return datetime.datetime.fromtimestamp(int(ts), datetime.timezone.utc)
+
+
+def get_session(pool_size=32) -> requests.Session:
+    """
+    Returns a process-wide requests Session so that connections (and TLS handshakes)
+    to the same host are reused across calls and threads.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_url(url, headers=None, retries=3, session=None):
     if headers is None:
         headers = {}
+    if session is None:
+        session = requests
 
     for i in range(retries):
         try:
-            r = requests.get(url, headers=headers, timeout=30)
+            r = session.get(url, headers=headers, timeout=30)
             if i == 0 and r.status_code == 404:
                 # NOMADS seems to have bad load balancing and will occasionally return 404
                 # for a file that has been previously fetched.
                 # Retry once
                 time.sleep(1)
-                r = requests.get(url, headers=headers)
+                r = session.get(url, headers=headers, timeout=30)
             break
         except KeyboardInterrupt:
             raise
@@ -53,7 +81,7 @@ def get_url(url, headers=None, retries=3):
 
 
 def url_exists(url):
-    r = requests.head(url, allow_redirects=True)
+    r = get_session().head(url, allow_redirects=True, timeout=30)
     return 200 <= r.status_code < 400
 
 
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Blends the models into synthesized sources: for each valid time and metric, every model's latest grid is
+regridded onto a common projection and the per-cell median and spread (std dev) across models are stored.
+"""
+from datetime import datetime, timedelta
+from scipy.spatial import cKDTree
+from typing import Dict, List, Optional, Tuple
+
+import argparse
+import json
+import logging
+import numpy
+import os
+import warnings
+
+from wx_explore.analysis.summarize import BLEND_SOURCE
+from wx_explore.common import metrics, storage, tracing
+from wx_explore.common.config import Config
+from wx_explore.common.location import get_lookup_meta
+from wx_explore.common.log_setup import init_sentry
+from wx_explore.common.models import Metric, Projection, Source, SourceField
+from wx_explore.ingest.common import get_or_create_synthesized_field
+from wx_explore.ingest.grid_store import GridStore, get_grid_store
+from wx_explore.web.core import app
+
+logger = logging.getLogger(__name__)
+
+BLEND_SOURCE_NAME = 'Model Blend (median)'
+SPREAD_SOURCE = 'blendspr'
+SPREAD_SOURCE_NAME = 'Model Blend (spread)'
+
+# Models to blend. The blend of each metric is on the grid of the one set by INGEST_BLEND_GRID, or else
+# of the one covering the most of the globe.
+BLEND_SOURCES = ['hrrr', 'nam', 'gfs']
+
+# Wind direction is left out since a median of angles isn't meaningful
+BLEND_METRICS = [
+    metrics.temp,
+    metrics.visibility,
+    metrics.raining,
+    metrics.ice,
+    metrics.freezing_rain,
+    metrics.snowing,
+    metrics.composite_reflectivity,
+    metrics.humidity,
+    metrics.pressure,
+    metrics.wind_speed,
+    metrics.gust_speed,
+    metrics.cloud_cover,
+]
+
+# Map of (source projection id, destination projection id) -> index into the flattened source grid for
+# each destination cell (-1 where the source doesn't cover it)
+_regrid_cache: Dict[Tuple[int, int], numpy.ndarray] = {}
+
+
+def _to_xyz(lats, lons):
+    """
+    Lat/lons to points on the unit sphere, so nearest neighbors don't have to care about the antimeridian.
+    """
+    lats = numpy.radians(lats, dtype=numpy.float64).ravel()
+    lons = numpy.radians(lons, dtype=numpy.float64).ravel()
+    cos_lat = numpy.cos(lats)
+    return numpy.column_stack((cos_lat * numpy.cos(lons), cos_lat * numpy.sin(lons), numpy.sin(lats)))
+
+
+def _nearest_index(src: Projection, lats, lons) -> numpy.ndarray:
+    """
+    :return: For each of the given points, the index of the nearest cell in flattened src, or -1 if src doesn't cover it
+    """
+    src_lats, src_lons = get_lookup_meta(src)
+    src_xyz = _to_xyz(src_lats, src_lons)
+    dist, idx = cKDTree(src_xyz).query(_to_xyz(lats, lons))
+
+    # Points further than a couple of source grid spacings from any source cell are outside the source's coverage
+    mid = src.n_y // 2
+    spacing = numpy.median(numpy.linalg.norm(numpy.diff(src_xyz[mid*src.n_x:(mid+1)*src.n_x], axis=0), axis=1))
+    idx[dist > 2 * spacing] = -1
+    return idx
+
+
+def get_regrid_index(src: Projection, dst: Projection) -> numpy.ndarray:
+    """
+    Nearest neighbor mapping from src's grid to dst's.
+    :return: For each cell of dst (flattened), the index of the nearest cell in flattened src, or -1 if src doesn't cover it
+    """
+    key = (src.id, dst.id)
+    if key not in _regrid_cache:
+        _regrid_cache[key] = _nearest_index(src, *get_lookup_meta(dst))
+    return _regrid_cache[key]
+
+
+# Map of projection id -> fraction of the globe it covers
+_coverage_cache: Dict[int, float] = {}
+
+
+def get_coverage(proj: Projection) -> float:
+    """
+    :return: Fraction of the globe proj covers, estimated from a 1 degree lat/lon grid weighted by cell area
+    """
+    if proj.id not in _coverage_cache:
+        lats, lons = numpy.meshgrid(numpy.arange(-89.5, 90), numpy.arange(-179.5, 180), indexing='ij')
+        weights = numpy.cos(numpy.radians(lats)).ravel()
+        covered = _nearest_index(proj, lats, lons) >= 0
+        _coverage_cache[proj.id] = float(weights[covered].sum() / weights.sum())
+    return _coverage_cache[proj.id]
+
+
+def blend_projection(fields: List[SourceField]) -> Projection:
+    """
+    :param fields: The models' fields of a metric
+    :return: The projection to blend the metric on: the one of INGEST_BLEND_GRID's field if it has one,
+             or else the one covering the most of the globe
+    """
+    for sf in fields:
+        if sf.source.short_name == Config.INGEST_BLEND_GRID:
+            return sf.projection
+    return max((sf.projection for sf in fields), key=get_coverage)
+
+
+def regrid(values: numpy.ndarray, src: Projection, dst: Projection) -> numpy.ndarray:
+    """
+    :return: values (on src's grid) on dst's grid as float32, with NaN where src doesn't cover dst
+    """
+    if src.id == dst.id:
+        return numpy.asarray(values, dtype=numpy.float32)
+
+    idx = get_regrid_index(src, dst)
+    out = numpy.full(idx.shape, numpy.nan, dtype=numpy.float32)
+    covered = idx >= 0
+    out[covered] = values.reshape(-1)[idx[covered]]
+    return out.reshape(dst.shape())
+
+
+class Blender(object):
+    """
+    Keeps track of which model runs each blended grid was made from (in the grid store, so it's shared by
+    every process running blends), so grids are only re-blended when one of their inputs changes.
+    """
+    grid_store: GridStore
+
+    def __init__(self, grid_store):
+        self.grid_store = grid_store
+        self.state_path = os.path.join(grid_store.root, 'blend_state.json')
+        try:
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+
+        self.sources = [Source.query.filter_by(short_name=name).first() for name in BLEND_SOURCES]
+
+    def save_state(self):
+        oldest = (datetime.utcnow() - timedelta(days=1)).isoformat()
+        self.state = {k: v for k, v in self.state.items() if k.split('/')[1] >= oldest}
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def input_fields(self, metric: Metric) -> List[SourceField]:
+        fields = []
+        for source in self.sources:
+            if source is None:
+                continue
+            sf = SourceField.query.filter_by(source_id=source.id, metric_id=metric.id).first()
+            if sf is not None and sf.projection_id is not None:
+                fields.append(sf)
+        return fields
+
+    def blend(self, metric: Metric, valid_time: datetime) -> Optional[Dict]:
+        """
+        :return: Map of projection to fields (as for put_fields) holding the blend of metric at valid_time,
+                 or None if the model on the blend's grid doesn't have it yet or its inputs haven't changed since
+                 it was last blended
+        """
+        fields = self.input_fields(metric)
+        if not fields:
+            return None
+        dst = blend_projection(fields)
+
+        inputs = []
+        for sf in fields:
+            res = self.grid_store.get(sf.id, valid_time)
+            if res is not None:
+                inputs.append((sf, res[0], res[1]))
+
+        # Only blend once a model on the blend's grid has the valid time, so the whole grid is covered.
+        # Beyond that, a single model is still blended (with no spread) so the blend covers its full range.
+        if not any(sf.projection_id == dst.id for sf, _, _ in inputs):
+            return None
+
+        state_key = f"{metric.id}/{valid_time.isoformat()}"
+        signature = sorted(f"{sf.id}:{run_time.isoformat()}" for sf, run_time, _ in inputs)
+        if self.state.get(state_key) == signature:
+            return None
+
+        with tracing.start_span('blend') as span:
+            span.set_attribute('metric', metric.name)
+            span.set_attribute('valid_time', str(valid_time))
+
+            # First member of each model (they're deterministic)
+            stack = numpy.stack([regrid(grid[0], sf.projection, dst) for sf, _, grid in inputs])
+            with warnings.catch_warnings():
+                # Cells with no value in any model (i.e. masked in the grid's own model) are left NaN, which
+                # readers treat as missing (see DataPointBatch.medians)
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                median = numpy.nanmedian(stack, axis=0).astype(numpy.float32, copy=False)
+                spread = numpy.nanstd(stack, axis=0).astype(numpy.float32, copy=False)
+
+        run_time = max(run_time for _, run_time, _ in inputs)
+        median_sf = get_or_create_synthesized_field(BLEND_SOURCE, BLEND_SOURCE_NAME, metric, dst.id)
+        spread_sf = get_or_create_synthesized_field(SPREAD_SOURCE, SPREAD_SOURCE_NAME, metric, dst.id)
+
+        # The median is also a grid other grid jobs (e.g. daily aggregates) can use
+        self.grid_store.put(median_sf.id, run_time, valid_time, [median])
+
+        self.state[state_key] = signature
+        return {
+            dst: {
+                (median_sf.id, valid_time, run_time): [median],
+                (spread_sf.id, valid_time, run_time): [spread],
+            },
+        }
+
+    def run(self, start: datetime, end: datetime):
+        """
+        Blends every hourly valid time in [start, end) which any model has data for.
+        """
+        for metric in BLEND_METRICS:
+            valid_times = set()
+            for sf in self.input_fields(metric):
+                valid_times.update(t for t in self.grid_store.valid_times(sf.id, start, end) if t.minute == 0)
+
+            for valid_time in sorted(valid_times):
+                blended = self.blend(metric, valid_time)
+                if blended is None:
+                    continue
+
+                logger.info("Blended %s at %s", metric.name, valid_time)
+                for proj, fields in blended.items():
+                    storage.get_provider().put_fields(proj, fields)
+
+            # Save progress after each metric so a crash doesn't redo everything
+            self.save_state()
+
+
+def blend_models(hours_ahead=240):
+    grid_store = get_grid_store()
+    if grid_store is None:
+        raise Exception("Blending requires the grid store (INGEST_GRID_DIR)")
+
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    Blender(grid_store).run(now - timedelta(hours=1), now + timedelta(hours=hours_ahead))
+
+
+if __name__ == "__main__":
+    init_sentry()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Blend models into a synthesized source')
+    parser.add_argument('--hours', type=int, default=240, help='Number of hours ahead to blend')
+    args = parser.parse_args()
+
+    with app.app_context():
+        blend_models(args.hours)
@@ -8,6 +8,7 @@ from wx_explore.common.log_setup import init_sentry
 from wx_explore.common.models import (
     FileBandMeta,
 )
+from wx_explore.ingest.grid_store import get_grid_store
 from wx_explore.web.core import db
 
 logger = logging.getLogger(__name__)
@@ -35,6 +36,10 @@ def clean_old_datas():
 
     storage.get_provider().clean(oldest_time)
 
+    grid_store = get_grid_store()
+    if grid_store is not None:
+        grid_store.clean(oldest_time)
+
 
 if __name__ == "__main__":
     init_sentry()
@@ -1,9 +1,15 @@
-from typing import TYPE_CHECKING
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
 import binascii
+import json
 import logging
 import numpy
+import threading
 
-from wx_explore.common.models import Projection
+from wx_explore.common.db_utils import get_or_create
+from wx_explore.common.models import IngestManifest, Metric, Projection, Source, SourceField
 from wx_explore.common.task_queue import pq
 from wx_explore.web.core import db
 
@@ -13,17 +19,180 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+# Base priority of each source's ingest items. Each hour of lead time lowers an item's priority by 1,
+# so e.g. an HRRR hour is worth as much as a GFS hour 48 hours nearer.
+SOURCE_PRIORITY = {
+    'hrrr': 48,
+    'nam': 24,
+    'gfs': 0,
+}
+
+
 def get_queue():
     return pq['ingest']
 
 
+def ingest_priority(source_name: str, lead_hours: int) -> int:
+    """
+    :return: Priority of ingesting the given forecast hour of a source. Higher priority items are dequeued first.
+    """
+    return SOURCE_PRIORITY.get(source_name, 0) - lead_hours
+
+
+def ingested_field_ids(source: Source) -> List[int]:
+    """
+    :return: Sorted ids of the source's fields which are stored directly from its GRIBs
+    """
+    return sorted(sf.id for sf in source.fields if sf.selectors is not None and not sf.metric.intermediate)
+
+
+def derivation_input_field_ids(source: Source) -> List[int]:
+    """
+    :return: Ids of the source's fields which derived fields are generated from (e.g. wind U/V components)
+    """
+    # Imported here since derivations need the ingest modules (and this one) loaded first
+    from wx_explore.ingest.derived import input_metric_ids
+
+    derivation_inputs = input_metric_ids()
+    return [sf.id for sf in source.fields if sf.metric.intermediate or sf.metric_id in derivation_inputs]
+
+
+def derived_field_ids(source: Source) -> List[int]:
+    """
+    :return: Ids of the source's fields which are generated by derivations (e.g. wind speed and direction)
+    """
+    from wx_explore.ingest.derived import derived_metric_ids
+
+    derived_metrics = derived_metric_ids()
+    return [sf.id for sf in source.fields if sf.metric_id in derived_metrics]
+
+
+def split_field_groups(source: Source, n_groups: int) -> List[List[int]]:
+    """
+    Splits the source's fields into (at most) n_groups groups which can be ingested independently.
+    Inputs of derived metrics (including intermediate fields like U/V, which aren't stored themselves) all
+    go in the first group along with the derived fields, since that's the only group which generates them.
+    :return: List of lists of SourceField ids
+    """
+    first = derivation_input_field_ids(source)
+    first += [field_id for field_id in derived_field_ids(source) if field_id not in first]
+    field_ids = [field_id for field_id in ingested_field_ids(source) if field_id not in first]
+
+    groups = [field_ids[i::n_groups] for i in range(min(n_groups, len(field_ids)))]
+    if not groups:
+        groups = [[]]
+    groups[0].extend(first)
+    return groups
+
+
+def get_ingested_valid_times(
+        source: Source,
+        run_time: datetime,
+        valid_times: Iterable[datetime],
+        field_ids: Optional[Iterable[int]] = None) -> Set[datetime]:
+    """
+    :param field_ids: Only check these fields (e.g. of a field group) rather than all of the source's
+    :return: The subset of valid_times for the given run which the manifest shows were already ingested
+             with (at least) all of the source's current fields
+    """
+    expected = set(ingested_field_ids(source))
+    if field_ids is not None:
+        expected &= set(field_ids)
+    entries = IngestManifest.query.filter(
+        IngestManifest.source_id == source.id,
+        IngestManifest.run_time == run_time,
+        IngestManifest.valid_time.in_(list(valid_times)),
+    ).all()
+    return {e.valid_time for e in entries if expected.issubset(e.source_field_ids)}
+
+
+def record_ingested(source: Source, run_time: datetime, field_ids_by_valid_time: Dict[datetime, Iterable[int]]):
+    """
+    Records in the manifest which fields were stored for each valid time of the given run.
+    Fields are added to those already recorded, since field groups of the same item are stored separately.
+    Changes are added to the session but not committed.
+    """
+    for valid_time, field_ids in field_ids_by_valid_time.items():
+        stmt = insert(IngestManifest.__table__).values(
+            source_id=source.id,
+            run_time=run_time,
+            valid_time=valid_time,
+            source_field_ids=sorted(field_ids),
+            ingested_at=datetime.utcnow(),
+        )
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['source_id', 'run_time', 'valid_time'],
+            set_={
+                'source_field_ids': text(
+                    "(SELECT jsonb_agg(DISTINCT f ORDER BY f) "
+                    "FROM jsonb_array_elements(ingest_manifest.source_field_ids || excluded.source_field_ids) AS f)"
+                ),
+                'ingested_at': stmt.excluded.ingested_at,
+            },
+        ))
+
+
+def get_or_create_synthesized_field(short_name: str, name: str, metric: Metric, projection_id: int) -> SourceField:
+    """
+    Gets (or creates) the field for metric of a synthesized source, i.e. one whose data is computed from
+    other sources' data rather than ingested from GRIBs (so its fields have no selectors).
+    """
+    source = get_or_create(Source(short_name=short_name, name=name))
+
+    sf = SourceField.query.filter_by(source_id=source.id, metric_id=metric.id).first()
+    if sf is None:
+        sf = SourceField(source_id=source.id, metric_id=metric.id, projection_id=projection_id)
+        db.session.add(sf)
+        db.session.commit()
+    elif sf.projection_id != projection_id:
+        logger.warning("Projection change in synthesized field %s", sf)
+        sf.projection_id = projection_id
+        db.session.commit()
+
+    return sf
+
+
+# Map of projection fingerprint (see projection_fingerprint) -> projection id
+_projection_cache: Dict[Tuple, int] = {}
+
+# Serializes projection lookup/creation between decode threads. Other processes are kept out by a
+# postgres advisory lock on the lat/lon hash while creating.
+_projection_lock = threading.Lock()
+
+
+def projection_fingerprint(msg) -> Tuple:
+    """
+    Identifies a message's grid using only header keys, so no lat/lons or values have to be computed.
+    """
+    return (
+        json.dumps(msg.projparams, sort_keys=True),
+        msg['Nj'],
+        msg['Ni'],
+        msg['latitudeOfFirstGridPointInDegrees'],
+        msg['longitudeOfFirstGridPointInDegrees'],
+    )
+
+
 def get_or_create_projection(msg):
+    fingerprint = projection_fingerprint(msg)
+    if fingerprint in _projection_cache:
+        projection = Projection.query.get(_projection_cache[fingerprint])
+        if projection is not None:
+            return projection
+
+    with _projection_lock:
+        projection = _get_or_create_projection(msg)
+        _projection_cache[fingerprint] = projection.id
+    return projection
+
+
+def _get_or_create_projection(msg):
     lats, lons = msg.latlons()
 
     # GFS (and maybe others) have lons that range 0-360 instead of -180 to 180.
     # If found, transform them to match the standard range.
     if lons.max() > 180:
-        lons = numpy.vectorize(lambda n: n if 0 <= n < 180 else n-360)(lons)
+        lons = numpy.where((lons >= 0) & (lons < 180), lons, lons - 360)
 
     ll_hash = binascii.crc32(numpy.round([lats, lons], 8).tobytes())
 
@@ -32,19 +201,30 @@ def get_or_create_projection(msg):
         ll_hash=ll_hash,
     ).first()
 
+    if projection is None:
+        # Held until the commit, and checked again under it in case another process just created it
+        db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': ll_hash})
+        projection = Projection.query.filter_by(
+            params=msg.projparams,
+            ll_hash=ll_hash,
+        ).first()
+
     if projection is None:
         logger.info("Creating new projection with params %s", msg.projparams)
 
         projection = Projection(
             params=msg.projparams,
-            n_x=msg.values.shape[1],
-            n_y=msg.values.shape[0],
+            n_x=lats.shape[1],
+            n_y=lats.shape[0],
             ll_hash=ll_hash,
             lats=lats.tolist(),
             lons=lons.tolist(),
         )
         db.session.add(projection)
         db.session.commit()
+    else:
+        # Releases the advisory lock, if taken
+        db.session.commit()
 
     return projection
 
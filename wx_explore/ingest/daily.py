@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Precomputes per-cell daily (UTC) aggregates of the model blend, stored as a synthesized source with one field
+per metric whose members are the values listed in summarize.DAILY_VALUES, so summaries can read a handful of
+values per day instead of deriving them from every hour.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import argparse
+import json
+import logging
+import numpy
+import os
+
+from wx_explore.analysis.summarize import BLEND_SOURCE, DAILY_SOURCE, DAILY_VALUES, CloudCoverEvent, PrecipEvent
+from wx_explore.common import metrics, storage, tracing
+from wx_explore.common.log_setup import init_sentry
+from wx_explore.common.models import Source, SourceField
+from wx_explore.ingest.common import get_or_create_synthesized_field
+from wx_explore.ingest.grid_store import GridStore, get_grid_store
+from wx_explore.web.core import app
+
+logger = logging.getLogger(__name__)
+
+DAILY_SOURCE_NAME = 'Daily Aggregates'
+
+DAY = timedelta(days=1)
+HOURS = 24
+
+# Lowest reflectivity (dbZ) which counts as precipitating, as in the summaries
+MIN_PRECIP_REFL = min(r.stop for r, intensity in PrecipEvent.CLASSIFICATIONS.items() if intensity == '')
+
+# Lower bounds of the sky condition classes but the first, for numpy.digitize
+CLOUD_COVER_EDGES = sorted(r.start for r in CloudCoverEvent.CLASSIFICATIONS)[1:]
+
+
+# (state key, signature of its inputs, blend field the aggregate is of, {hour: (run time, grid)} it was computed from, values)
+Aggregate = Tuple[str, List[str], SourceField, Dict, List[numpy.ndarray]]
+
+
+class DailyAggregator(object):
+    """
+    Like Blender, keeps track of the runs each day was aggregated from so days are only redone when their inputs change.
+    A day's inputs are only recorded once its aggregate is stored, so aggregates which couldn't be made are tried again.
+    """
+    grid_store: GridStore
+
+    def __init__(self, grid_store):
+        self.grid_store = grid_store
+        self.state_path = os.path.join(grid_store.root, 'daily_state.json')
+        try:
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+
+        blend = Source.query.filter_by(short_name=BLEND_SOURCE).first()
+        self.fields = {}
+        if blend is not None:
+            self.fields = {sf.metric_id: sf for sf in SourceField.query.filter_by(source_id=blend.id).all()}
+
+    def save_state(self):
+        oldest = (datetime.utcnow() - DAY).isoformat()
+        self.state = {k: v for k, v in self.state.items() if k.split('/')[1] >= oldest}
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def hours(self, metric, day):
+        """
+        :return: Map of hour of day -> (run time, grid) of the blend of metric
+        """
+        sf = self.fields.get(metric.id)
+        if sf is None:
+            return {}
+
+        hours = {}
+        for valid_time in self.grid_store.valid_times(sf.id, day, day + DAY):
+            if valid_time.minute != 0:
+                continue
+            res = self.grid_store.get(sf.id, valid_time)
+            if res is not None:
+                hours[valid_time.hour] = (res[0], res[1][0])
+        return hours
+
+    def signature(self, key, *hours) -> Optional[List[str]]:
+        """
+        :return: Signature of the runs the aggregate under key would be made from, or None if there are none or
+                 they're the ones it was last stored from
+        """
+        signature = sorted(f"{hour}:{run_time.isoformat()}" for h in hours for hour, (run_time, _) in h.items())
+        if not signature or self.state.get(key) == signature:
+            return None
+        return signature
+
+    def temps(self, day) -> Optional[Aggregate]:
+        hours = self.hours(metrics.temp, day)
+        key = f"{metrics.temp.id}/{day.isoformat()}"
+        signature = self.signature(key, hours)
+        if signature is None:
+            return None
+
+        hour_of = numpy.array(sorted(hours), dtype=numpy.float32)
+        grids = numpy.stack([hours[hour][1] for hour in sorted(hours)]).astype(numpy.float32, copy=False)
+        missing = numpy.isnan(grids)
+
+        # fmax/fmin ignore NaN (cells the blend doesn't cover)
+        high = numpy.fmax.reduce(grids, axis=0)
+        low = numpy.fmin.reduce(grids, axis=0)
+        high_hour = hour_of[numpy.where(missing, -numpy.inf, grids).argmax(axis=0)]
+        low_hour = hour_of[numpy.where(missing, numpy.inf, grids).argmin(axis=0)]
+        # Cells without any value have no hour either
+        high_hour[numpy.isnan(high)] = numpy.nan
+        low_hour[numpy.isnan(low)] = numpy.nan
+
+        return key, signature, self.fields[metrics.temp.id], hours, [high, low, high_hour, low_hour]
+
+    def precip(self, metric, day) -> Optional[Aggregate]:
+        """
+        Onset and duration of the first window of metric (a precip flag) with precipitating reflectivity.
+        """
+        flag_hours = self.hours(metric, day)
+        refl_hours = self.hours(metrics.composite_reflectivity, day)
+        key = f"{metric.id}/{day.isoformat()}"
+        signature = self.signature(key, flag_hours, refl_hours)
+        if signature is None:
+            return None
+
+        flag_sf = self.fields[metric.id]
+        refl_sf = self.fields.get(metrics.composite_reflectivity.id)
+        if refl_sf is None or refl_sf.projection_id != flag_sf.projection_id:
+            logger.warning("No reflectivity on the grid of %s, skipping its daily aggregates", flag_sf)
+            return None
+
+        precipitating = numpy.zeros((HOURS,) + flag_sf.projection.shape(), dtype=bool)
+        for hour in flag_hours.keys() & refl_hours.keys():
+            # Matches the summaries, which count a flag as set when the median is 1
+            numpy.logical_and(flag_hours[hour][1] >= 1, refl_hours[hour][1] >= MIN_PRECIP_REFL, out=precipitating[hour])
+
+        any_precip = precipitating.any(axis=0)
+        onset = precipitating.argmax(axis=0)
+        # The first hour at/after onset without precip ends the window
+        stopped = (numpy.arange(HOURS)[:, None, None] >= onset) & ~precipitating
+        end = numpy.where(stopped.any(axis=0), stopped.argmax(axis=0), HOURS)
+
+        return key, signature, flag_sf, {**flag_hours, **refl_hours}, [
+            numpy.where(any_precip, onset, numpy.nan).astype(numpy.float32),
+            numpy.where(any_precip, end - onset, 0).astype(numpy.float32),
+        ]
+
+    def cloud_cover(self, day) -> Optional[Aggregate]:
+        """
+        Mean cover of the hours in the most common sky condition class.
+        """
+        hours = self.hours(metrics.cloud_cover, day)
+        key = f"{metrics.cloud_cover.id}/{day.isoformat()}"
+        signature = self.signature(key, hours)
+        if signature is None:
+            return None
+
+        sf = self.fields[metrics.cloud_cover.id]
+        n_classes = len(CLOUD_COVER_EDGES) + 1
+        counts = numpy.zeros((n_classes,) + sf.projection.shape(), dtype=numpy.int16)
+        totals = numpy.zeros((n_classes,) + sf.projection.shape(), dtype=numpy.float32)
+        for _, grid in hours.values():
+            classes = numpy.digitize(grid, CLOUD_COVER_EDGES)
+            for c in range(n_classes):
+                in_class = (classes == c) & ~numpy.isnan(grid)
+                counts[c] += in_class
+                totals[c] += numpy.where(in_class, grid, 0)
+
+        dominant = counts.argmax(axis=0)[None]
+        n = numpy.take_along_axis(counts, dominant, axis=0)[0]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            cover = numpy.take_along_axis(totals, dominant, axis=0)[0] / n
+
+        return key, signature, sf, hours, [numpy.where(n > 0, cover, numpy.nan).astype(numpy.float32)]
+
+    def aggregate(self, day: datetime) -> Dict:
+        """
+        :return: Map of projection to (fields (as for put_fields), {state key: signature}) of every aggregate of day
+                 whose inputs changed
+        """
+        results = [
+            self.temps(day),
+            self.precip(metrics.raining, day),
+            self.precip(metrics.snowing, day),
+            self.cloud_cover(day),
+        ]
+
+        to_insert = {}
+        for res in results:
+            if res is None:
+                continue
+            key, signature, blend_sf, hours, values = res
+            assert len(values) == len(DAILY_VALUES[blend_sf.metric_id])
+
+            sf = get_or_create_synthesized_field(DAILY_SOURCE, DAILY_SOURCE_NAME, blend_sf.metric, blend_sf.projection_id)
+            run_time = max(run_time for run_time, _ in hours.values())
+            fields, signatures = to_insert.setdefault(blend_sf.projection, ({}, {}))
+            fields[(sf.id, day, run_time)] = values
+            signatures[key] = signature
+
+        return to_insert
+
+    def run(self, start: datetime, days: int):
+        for i in range(days):
+            day = start + DAY * i
+            with tracing.start_span('daily aggregates') as span:
+                span.set_attribute('day', str(day))
+                aggregated = self.aggregate(day)
+
+            for proj, (fields, signatures) in aggregated.items():
+                logger.info("Storing %d daily aggregates for %s", len(fields), day.date())
+                storage.get_provider().put_fields(proj, fields)
+                self.state.update(signatures)
+
+            self.save_state()
+
+
+def aggregate_days(days=10):
+    """
+    Aggregates today (UTC) and the following days.
+    """
+    grid_store = get_grid_store()
+    if grid_store is None:
+        raise Exception("Daily aggregates require the grid store (INGEST_GRID_DIR)")
+
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    DailyAggregator(grid_store).run(today, days)
+
+
+if __name__ == "__main__":
+    init_sentry()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Compute daily aggregates of the model blend')
+    parser.add_argument('--days', type=int, default=10, help='Number of days to aggregate')
+    args = parser.parse_args()
+
+    with app.app_context():
+        aggregate_days(args.days)
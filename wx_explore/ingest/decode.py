@@ -0,0 +1,103 @@
+"""
+GRIB decoding which doesn't touch the app or database, so it is safe to run in decode worker processes.
+"""
+from typing import List, Tuple
+
+import numpy
+import os
+import pygrib
+import tempfile
+
+# tmpfs, so buffers here are shared memory rather than disk. Fall back to the normal temp dir elsewhere.
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def read_grib_bytes(data, multi_field=False):
+    """
+    Reads the GRIB message(s) in data.
+    :param multi_field: Whether data is a single GRIB message holding several fields
+                        (e.g. NAM's 10m U+V in one message, listed as 624.1/624.2 in its idx)
+    :return: List of pygrib messages, one per field
+    """
+    if not multi_field:
+        return [pygrib.fromstring(data)]
+
+    # pygrib.fromstring only decodes the first field of a multi-field message,
+    # so these (rare) chunks go through a file which pygrib.open can split.
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        return list(pygrib.open(f.name))
+
+
+def value_shapes(msgs) -> List[Tuple[int, int]]:
+    """
+    Shape of each message's values, read from its grid definition without decoding the data.
+    """
+    return [(msg['Nj'], msg['Ni']) for msg in msgs]
+
+
+class SharedValues(object):
+    """
+    A float32 buffer in shared memory which a decode worker process fills with the values of
+    one GRIB chunk, so the arrays never have to be pickled back to the parent.
+    """
+    path: str
+    shapes: List[Tuple[int, int]]
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        fd, self.path = tempfile.mkstemp(prefix='wx_decode_', dir=SHARED_DIR)
+        try:
+            os.ftruncate(fd, max(4 * sum(ny * nx for ny, nx in shapes), 4))
+        finally:
+            os.close(fd)
+
+    def views(self) -> List[numpy.ndarray]:
+        """
+        Maps the values written by the worker into this process (without copying) and releases the buffer's name.
+        The memory itself is freed once the returned arrays are no longer referenced.
+        """
+        buf = numpy.memmap(self.path, dtype=numpy.float32, mode='r+')
+        self.release()
+
+        arrs = []
+        offset = 0
+        for ny, nx in self.shapes:
+            arrs.append(buf[offset:offset+ny*nx].reshape((ny, nx)))
+            offset += ny * nx
+        return arrs
+
+    def release(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _write_values(out_path, msgs):
+    out = numpy.memmap(out_path, dtype=numpy.float32, mode='r+')
+    offset = 0
+    for msg in msgs:
+        vals = msg.values
+        if numpy.ma.isMaskedArray(vals):
+            vals = vals.filled(numpy.nan)
+        out[offset:offset+vals.size] = vals.ravel()
+        offset += vals.size
+    out.flush()
+
+
+def decode_bytes_into(out_path, data, multi_field=False):
+    """
+    Decodes GRIB chunk data into the SharedValues at out_path.
+    """
+    _write_values(out_path, read_grib_bytes(data, multi_field))
+
+
+def decode_file_chunk_into(out_path, file_path, offset, length, multi_field=False):
+    """
+    Decodes the GRIB message at offset in file_path into the SharedValues at out_path.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    _write_values(out_path, read_grib_bytes(data, multi_field))
@@ -0,0 +1,173 @@
+"""
+Registry of metrics which are derived from other metrics at ingest time (e.g. wind speed/direction from U/V).
+
+Each derivation declares its input and output metrics and a NumPy kernel. Derivations are evaluated as a
+DAG (outputs of one can be inputs of another) over the messages already decoded for the file being ingested,
+so adding a derived metric never costs another pass over the GRIB.
+"""
+from typing import Callable, Dict, List, Tuple
+
+import collections
+import logging
+import numpy
+
+from wx_explore.analysis.transformations import cartesian_to_polar
+from wx_explore.common import metrics
+from wx_explore.common.models import Metric, Source
+from wx_explore.ingest.common import get_or_create_projection
+from wx_explore.ingest.grib import get_end_valid_time
+from wx_explore.ingest.units import message_units, metric_units, normalize
+from wx_explore.web.core import db
+
+logger = logging.getLogger(__name__)
+
+
+class Derivation(object):
+    name: str
+    inputs: List[Metric]
+    outputs: List[Metric]
+    # Called with a float32 array per input, in the input metrics' units (which must not be modified).
+    # Returns an array per output, in the output metrics' units.
+    kernel: Callable[..., Tuple[numpy.ndarray, ...]]
+
+    def __init__(self, name, inputs, outputs, kernel):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.kernel = kernel
+
+    def __repr__(self):
+        return f"<Derivation name='{self.name}'>"
+
+
+DERIVATIONS: List[Derivation] = []
+
+# Selectors for input fields whose SourceField has none (because they're never stored themselves)
+DEFAULT_INPUT_SELECTORS = {
+    metrics.wind_u.id: {'name': '10 metre U wind component', 'stepType': 'instant'},
+    metrics.wind_v.id: {'name': '10 metre V wind component', 'stepType': 'instant'},
+}
+
+
+def register(inputs, outputs):
+    """
+    Decorator which registers a kernel computing outputs from inputs (both lists of Metric).
+    """
+    def wrapper(kernel):
+        DERIVATIONS.append(Derivation(kernel.__name__, inputs, outputs, kernel))
+        return kernel
+    return wrapper
+
+
+@register(inputs=[metrics.wind_u, metrics.wind_v], outputs=[metrics.wind_speed, metrics.wind_direction])
+def wind(u, v):
+    return cartesian_to_polar(u, v)
+
+
+def evaluation_order() -> List[Derivation]:
+    """
+    :return: DERIVATIONS sorted so each comes after the derivations producing its inputs
+    """
+    producers = {m.id: d for d in DERIVATIONS for m in d.outputs}
+
+    ordered = []
+    visiting = set()
+
+    def visit(d):
+        if d in ordered:
+            return
+        if d in visiting:
+            raise ValueError(f"Derivation {d} depends on its own output")
+        visiting.add(d)
+        for m in d.inputs:
+            if m.id in producers:
+                visit(producers[m.id])
+        visiting.remove(d)
+        ordered.append(d)
+
+    for d in DERIVATIONS:
+        visit(d)
+    return ordered
+
+
+def derived_metric_ids() -> set:
+    return {m.id for d in DERIVATIONS for m in d.outputs}
+
+
+def input_metric_ids() -> set:
+    """
+    :return: Ids of metrics which must be read from the GRIB for some derivation
+    """
+    return {m.id for d in DERIVATIONS for m in d.inputs} - derived_metric_ids()
+
+
+def derive(grib, source: Source) -> Dict:
+    """
+    Evaluates every derivation whose outputs source has fields for, over the messages in grib.
+    :param grib: GribIndex of the file being ingested
+    :return: Map of projection to map of {(field_id, valid_time, run_time) -> [values]}
+    """
+    fields_by_metric = {sf.metric_id: sf for sf in source.fields}
+
+    # Only evaluate what's needed for the outputs this source has (walking the DAG backwards from them)
+    wanted = set(fields_by_metric) & derived_metric_ids()
+    needed = []
+    for d in reversed(evaluation_order()):
+        if any(m.id in wanted for m in d.outputs):
+            needed.append(d)
+            wanted.update(m.id for m in d.inputs)
+    needed.reverse()
+    if not needed:
+        return {}
+
+    metrics_by_id = {m.id: m for d in needed for m in d.inputs}
+
+    # Map of (valid_time, run_time) -> metric id -> values, plus a message of each for its projection
+    env = collections.defaultdict(dict)
+    template_msgs = {}
+    for metric_id in {m.id for d in needed for m in d.inputs} - derived_metric_ids():
+        sf = fields_by_metric.get(metric_id)
+        selectors = (sf.selectors if sf is not None else None) or DEFAULT_INPUT_SELECTORS.get(metric_id)
+        if selectors is None:
+            continue
+
+        try:
+            msgs = grib.select(**selectors)
+        except ValueError:
+            logger.warning("Could not find input message(s) matching %s", selectors)
+            continue
+
+        for msg in msgs:
+            key = (get_end_valid_time(msg), msg.analDate)
+            env[key][metric_id] = normalize(msg.values, message_units(msg), metric_units(metrics_by_id[metric_id]))
+            template_msgs.setdefault(key, msg)
+
+    to_insert = collections.defaultdict(dict)
+    for key, values in env.items():
+        for d in needed:
+            if not all(m.id in values for m in d.inputs):
+                continue
+
+            outputs = d.kernel(*(values[m.id] for m in d.inputs))
+            for m, out in zip(d.outputs, outputs):
+                values[m.id] = out
+
+        projection = get_or_create_projection(template_msgs[key])
+        for metric_id, out in values.items():
+            sf = fields_by_metric.get(metric_id)
+            if metric_id not in derived_metric_ids() or sf is None:
+                continue
+
+            if sf.projection_id is None:
+                sf.projection_id = projection.id
+            elif sf.projection_id != projection.id:
+                logger.error("Projection change in derived field %s", sf)
+
+            to_insert[projection][(sf.id, key[0], key[1])] = [out]
+
+    db.session.commit()
+
+    if not to_insert:
+        logger.warning("No derived fields generated")
+
+    return dict(to_insert)
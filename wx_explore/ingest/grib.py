@@ -1,38 +1,149 @@
 import collections
+import concurrent.futures
 import datetime
 import logging
+import numpy
 import pygrib
+import resource
+import threading
+import time
+import urllib.parse
 
 from wx_explore.common import tracing, storage
 from wx_explore.common.models import (
     Metric,
+    Projection,
     SourceField,
 )
-from wx_explore.common.utils import get_url
-from wx_explore.ingest.common import get_or_create_projection, get_source_module
+from wx_explore.common.utils import get_url, get_session
+from wx_explore.ingest.common import derivation_input_field_ids, get_or_create_projection, get_source_module
+from wx_explore.ingest.decode import (
+    SharedValues,
+    decode_bytes_into,
+    decode_file_chunk_into,
+    read_grib_bytes,
+    value_shapes,
+)
+from wx_explore.ingest.grid_store import get_grid_store
+from wx_explore.ingest.range_cache import get_range_cache
+from wx_explore.ingest.rollup import rollup_fields
+from wx_explore.ingest.units import message_units, metric_units, normalize
 from wx_explore.web.core import db
 
 logger = logging.getLogger(__name__)
 
+# Default amount of decoded field data ingest_grib_file holds before flushing it to the storage backend
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
 
-def get_grib_ranges(idxs, source_fields):
+# Ranges separated by at most this many bytes are fetched with a single request.
+# The bytes in between are downloaded but never written out.
+DEFAULT_MAX_GAP = 64 * 1024
+
+
+# A single parsed line of a GRIB .idx file
+IdxEntry = collections.namedtuple('IdxEntry', ['msg_num', 'offset', 'short_name', 'level'])
+
+# Map of idx URL -> (ETag, time fetched, [IdxEntry, ...]), in least to most recently used order
+_idx_cache = collections.OrderedDict()
+_idx_cache_lock = threading.Lock()
+IDX_CACHE_SIZE = 512
+
+
+def parse_idx(idxs):
     """
-    Given an index file, return a list of tuples that denote the start and length of each chunk
-    of the GRIB that should be downloaded
+    Parses the text of a GRIB .idx file
     :param idxs: Index file as a string
-    :param source: List of SourceField that should be extracted from the GRIB
-    :return: List of (start, length)
+    :return: List of IdxEntry
     """
-    offsets = []
-    last = None
+    entries = []
     for line in idxs.split('\n'):
         tokens = line.split(':')
         if len(tokens) < 7:
             continue
 
-        _, offset, _, short_name, level, _, _ = tokens
+        entries.append(IdxEntry(tokens[0], int(tokens[1]), tokens[3], tokens[4]))
+
+    return entries
+
+
+def get_idx(idx_url, max_age=60):
+    """
+    Fetches and parses the .idx file at idx_url.
+    Parsed files are cached by URL. A cached copy younger than max_age seconds is returned
+    without a request; older copies are revalidated against the server's ETag so unchanged
+    files are not downloaded or parsed again.
+    :return: List of IdxEntry
+    """
+    with _idx_cache_lock:
+        cached = _idx_cache.get(idx_url)
+
+    if cached is not None and time.time() - cached[1] < max_age:
+        return cached[2]
 
-        offset = int(offset)
+    headers = {}
+    if cached is not None and cached[0] is not None:
+        headers['If-None-Match'] = cached[0]
+
+    r = get_url(idx_url, headers=headers, session=get_session())
+    if r.status_code == 304:
+        entries = cached[2]
+    else:
+        entries = parse_idx(r.text)
+
+    with _idx_cache_lock:
+        _idx_cache[idx_url] = (r.headers.get('ETag', cached[0] if cached is not None else None), time.time(), entries)
+        _idx_cache.move_to_end(idx_url)
+        while len(_idx_cache) > IDX_CACHE_SIZE:
+            _idx_cache.popitem(last=False)
+
+    return entries
+
+
+def get_idx_version(idx_url):
+    """
+    :return: ETag of the .idx file at idx_url as of its last get_idx, or None if unknown. A GRIB is always
+             re-published with its idx, so this also identifies the version of the GRIB the idx describes.
+    """
+    with _idx_cache_lock:
+        cached = _idx_cache.get(idx_url)
+    return cached[0] if cached is not None else None
+
+
+def get_multi_field_offsets(idx):
+    """
+    :param idx: List of IdxEntry
+    :return: Set of offsets of messages which hold multiple fields (sub-numbered in the idx, e.g. 624.1, 624.2)
+    """
+    return {entry.offset for entry in idx if '.' in entry.msg_num}
+
+
+def compile_field_matcher(source_fields):
+    """
+    :return: Dict of (idx_short_name, idx_level) -> [SourceField, ...]
+    """
+    matcher = collections.defaultdict(list)
+    for sf in source_fields:
+        matcher[(sf.idx_short_name, sf.idx_level)].append(sf)
+    return matcher
+
+
+def get_grib_ranges(idxs, source_fields):
+    """
+    Given an index file, return a list of tuples that denote the start and length of each chunk
+    of the GRIB that should be downloaded
+    :param idxs: Index file as a string, or already parsed list of IdxEntry
+    :param source: List of SourceField that should be extracted from the GRIB
+    :return: List of (start, length)
+    """
+    if isinstance(idxs, str):
+        idxs = parse_idx(idxs)
+
+    matcher = compile_field_matcher(source_fields)
+
+    offsets = []
+    last = None
+    for entry in idxs:
+        offset = entry.offset
 
         # NAM apparently has index fields like
         # 624.1:698199214:d=2020020918:UGRD:10 m above ground:5 hour fcst:
@@ -42,38 +153,286 @@ def get_grib_ranges(idxs, source_fields):
             offsets.append((last, offset-last))
             last = None
 
-        if any(sf.idx_short_name == short_name and sf.idx_level == level for sf in source_fields):
+        if (entry.short_name, entry.level) in matcher:
             last = offset
 
     return offsets
 
 
-def reduce_grib(grib_url, idx_url, source_fields, out_f):
+def plan_range_requests(ranges, max_gap=DEFAULT_MAX_GAP):
+    """
+    Merges ranges which are adjacent or separated by at most max_gap bytes so they can be fetched together.
+    :param ranges: List of (start, length)
+    :param max_gap: Largest number of unneeded bytes to download to save a request
+    :return: List of (start, length, [(start, length), ...]) with each request and the ranges it covers
+    """
+    planned = []
+    for start, length in sorted(ranges):
+        if planned and start - (planned[-1][0] + planned[-1][1]) <= max_gap:
+            req_start, req_length, parts = planned[-1]
+            planned[-1] = (req_start, max(req_length, start + length - req_start), parts + [(start, length)])
+        else:
+            planned.append((start, length, [(start, length)]))
+
+    return planned
+
+
+def _fetch_range(url, start, length, version=None):
+    """
+    :param version: Version of url (see get_idx_version). Ranges are only read from and written to the cache when it is known.
+    """
+    cache = get_range_cache() if version is not None else None
+    if cache is not None:
+        data = cache.get(url, version, start, length)
+        if data is not None:
+            return data
+
+    r = get_url(url, headers={
+        "Range": f"bytes={start}-{start+length-1}"
+    }, session=get_session())
+
+    if cache is not None:
+        cache.put(url, version, start, length, r.content)
+
+    return r.content
+
+
+def _log_transfer(url, n_bytes, n_requests, n_ranges, t_start):
+    elapsed = max(time.time() - t_start, 1e-6)
+    logger.info("Downloaded %d bytes in %d requests (%d ranges) from %s in %.2fs (%.0f bytes/s)",
+                n_bytes, n_requests, n_ranges, urllib.parse.urlsplit(url).netloc, elapsed, n_bytes / elapsed)
+
+
+def download_ranges(url, ranges, out_f, max_gap=DEFAULT_MAX_GAP, n_workers=8, version=None):
+    """
+    Fetches the given byte ranges of url concurrently over a shared session, writing them to out_f in order.
+    :param ranges: List of (start, length)
+    :param version: Version of url (the ETag of the idx the ranges came from, see get_idx_version), which
+                    the range cache is keyed by. Ranges aren't cached if it's None.
+    :return: Number of ranges written
+    """
+    planned = plan_range_requests(ranges, max_gap)
+
+    n_written = 0
+    n_bytes = 0
+    t_start = time.time()
+
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as ex:
+        futures = [ex.submit(_fetch_range, url, req_start, req_length, version) for req_start, req_length, _ in planned]
+
+        # Futures are consumed in plan (= file) order, so earlier ranges are written while later ones download
+        for (req_start, _, parts), fut in zip(planned, futures):
+            try:
+                data = fut.result()
+            except Exception:
+                logger.exception("Unable to fetch grib data. Continuing anyways...")
+                continue
+
+            n_bytes += len(data)
+            for start, length in parts:
+                out_f.write(data[start-req_start:start-req_start+length])
+                n_written += 1
+
+    _log_transfer(url, n_bytes, len(planned), len(ranges), t_start)
+
+    return n_written
+
+
+def stream_ranges(url, ranges, max_gap=DEFAULT_MAX_GAP, n_workers=8, version=None):
+    """
+    Like download_ranges, but yields each range as soon as the request covering it completes
+    (in completion order, not file order) so callers can process data while the rest downloads.
+    :param ranges: List of (start, length)
+    :param version: As for download_ranges
+    :return: Generator of (start, bytes)
+    """
+    planned = plan_range_requests(ranges, max_gap)
+
+    n_bytes = 0
+    t_start = time.time()
+
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as ex:
+        futures = {
+            ex.submit(_fetch_range, url, req_start, req_length, version): (req_start, parts)
+            for req_start, req_length, parts in planned
+        }
+
+        for fut in concurrent.futures.as_completed(futures):
+            req_start, parts = futures[fut]
+            try:
+                data = fut.result()
+            except Exception:
+                logger.exception("Unable to fetch grib data. Continuing anyways...")
+                continue
+
+            n_bytes += len(data)
+            for start, length in parts:
+                yield start, data[start-req_start:start-req_start+length]
+
+    _log_transfer(url, n_bytes, len(planned), len(ranges), t_start)
+
+
+def reduce_grib(grib_url, idx_url, source_fields, out_f, max_gap=DEFAULT_MAX_GAP):
     """
     Downloads the appropriate chunks (based on desired fields described by source_fields)
     of the GRIB at grib_url (using idx_url to quickly seek around) and writes the chunks
     to out_f.
 
     It is assumed that the caller has checked that the URLs exist before this function is called.
+    :param max_gap: Largest number of unneeded bytes between two chunks to download to save a request
+    :return: Number of GRIB chunks written
+    """
+    offsets = get_grib_ranges(get_idx(idx_url), source_fields)
+
+    n_written = download_ranges(grib_url, offsets, out_f, max_gap=max_gap, version=get_idx_version(idx_url))
+
+    out_f.flush()
+
+    return n_written
+
+
+class DecodedMessage(object):
+    """
+    A pygrib message whose values have already been decoded.
+    Everything other than values is passed through to the underlying message.
+    """
+
+    def __init__(self, msg, values=None):
+        self.msg = msg
+        self.values = values if values is not None else msg.values
+
+    def __getattr__(self, name):
+        return getattr(self.msg, name)
+
+    def __getitem__(self, key):
+        return self.msg[key]
+
+    def __str__(self):
+        return str(self.msg)
+
+
+def decode_grib_bytes(data, multi_field=False):
+    """
+    Decodes the GRIB message(s) in data without touching disk.
+    :param multi_field: Whether data is a single GRIB message holding several fields (see read_grib_bytes)
+    :return: List of DecodedMessage
+    """
+    return [DecodedMessage(msg) for msg in read_grib_bytes(data, multi_field)]
+
+
+def decode_in_pool(pool, chunks):
+    """
+    Decodes the values of GRIB chunks across a process pool. Workers write values straight into
+    shared memory instead of pickling them back, while metadata stays with the (lazily read) messages here.
+    :param chunks: List of (msgs, func, args) where msgs are the chunk's undecoded messages and
+                   func(out_path, *args) decodes the chunk's values into out_path (e.g. decode_bytes_into)
+    :return: List of DecodedMessage for each chunk (empty if the chunk couldn't be decoded)
     """
-    idxs = get_url(idx_url).text
-    offsets = get_grib_ranges(idxs, source_fields)
+    pending = []
+    try:
+        for msgs, func, args in chunks:
+            shared = SharedValues(value_shapes(msgs))
+            pending.append((msgs, shared, pool.submit(func, shared.path, *args)))
+
+        decoded = []
+        for msgs, shared, fut in pending:
+            try:
+                fut.result()
+            except Exception:
+                logger.exception("Unable to decode grib chunk. Continuing anyways...")
+                decoded.append([])
+                continue
+            decoded.append([DecodedMessage(msg, values) for msg, values in zip(msgs, shared.views())])
+
+        return decoded
+    finally:
+        for _, shared, _ in pending:
+            shared.release()
+
+
+def decode_bytes_in_pool(pool, chunks):
+    """
+    :param chunks: List of (bytes, multi_field)
+    :return: List of DecodedMessage for each chunk
+    """
+    return decode_in_pool(pool, [
+        (read_grib_bytes(data, multi_field), decode_bytes_into, (data, multi_field))
+        for data, multi_field in chunks
+    ])
+
 
-    for offset, length in offsets:
-        start = offset
-        end = offset + length - 1
+def stream_grib_messages(grib_url, idx_url, source_fields, max_gap=DEFAULT_MAX_GAP):
+    """
+    Downloads the chunks of the GRIB at grib_url needed for source_fields (see reduce_grib) and
+    decodes each straight from memory as it arrives, overlapping decoding with the remaining downloads.
+    :return: Generator of DecodedMessage
+    """
+    idx = get_idx(idx_url)
+    ranges = get_grib_ranges(idx, source_fields)
+    multi_field_offsets = get_multi_field_offsets(idx)
 
+    for start, data in stream_ranges(grib_url, ranges, max_gap=max_gap, version=get_idx_version(idx_url)):
         try:
-            grib_data = get_url(grib_url, headers={
-                "Range": f"bytes={start}-{end}"
-            }).content
-        except Exception as e:
-            logger.exception("Unable to fetch grib data. Continuing anyways...")
-            continue
+            yield from decode_grib_bytes(data, start in multi_field_offsets)
+        except Exception:
+            logger.exception("Unable to decode grib chunk at offset %d. Continuing anyways...", start)
 
-        out_f.write(grib_data)
 
-    out_f.flush()
+class GribIndex(object):
+    """
+    In-memory index of every message in a GRIB, built from a single pass over the file.
+
+    Supports the subset of pygrib's select() that ingest uses, but lookups are served from
+    per-key maps of value -> messages instead of rescanning the file for each call.
+    """
+
+    def __init__(self, msgs):
+        self.msgs = list(msgs)
+        # Map of key -> {value -> [msg idx, ...]}, built lazily the first time a key is selected on
+        self._key_indexes = {}
+
+    @classmethod
+    def open(cls, file_path):
+        return cls(pygrib.open(file_path))
+
+    def __iter__(self):
+        return iter(self.msgs)
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def _key_index(self, key):
+        if key not in self._key_indexes:
+            idx = collections.defaultdict(list)
+            for i, msg in enumerate(self.msgs):
+                if msg.valid_key(key):
+                    idx[msg[key]].append(i)
+            self._key_indexes[key] = idx
+
+        return self._key_indexes[key]
+
+    def _matching(self, key, value):
+        if callable(value):
+            return {i for i, msg in enumerate(self.msgs) if msg.valid_key(key) and value(msg[key])}
+        if isinstance(value, (list, tuple, set)):
+            idx = self._key_index(key)
+            return {i for v in value for i in idx.get(v, ())}
+        return set(self._key_index(key).get(value, ()))
+
+    def select(self, **selectors):
+        """
+        Returns all messages matching selectors, in file order.
+        Like pygrib, raises ValueError if nothing matches.
+        """
+        matching = None
+        for key, value in selectors.items():
+            hits = self._matching(key, value)
+            matching = hits if matching is None else (matching & hits)
+
+        if not matching:
+            raise ValueError("no matches found")
+
+        return [self.msgs[i] for i in sorted(matching)]
 
 
 def get_end_valid_time(msg):
@@ -100,22 +459,76 @@ def get_end_valid_time(msg):
     return valid_date
 
 
-def ingest_grib_file(file_path, source):
+def ingest_grib_file(file_path, source, memory_budget=DEFAULT_MEMORY_BUDGET, decode_pool=None):
     """
     Ingests a given GRIB file into the backend.
     :param file_path: Path to the GRIB file
     :param source: Source object which denotes which source this data is from
+    :param memory_budget: Max bytes of decoded data to hold before flushing to the backend (None for no limit)
+    :param decode_pool: Optional process pool to decode messages in parallel. All messages are
+                        decoded up front, so this trades the memory bound for throughput.
     :return: None
     """
     logger.info("Processing GRIB file '%s'", file_path)
 
-    grib = pygrib.open(file_path)
+    # Read every message once up front; all field and derived lookups are served from this index
+    with tracing.start_span('index grib') as span:
+        grib = GribIndex.open(file_path)
+        span.set_attribute('num_messages', len(grib))
+
+    if decode_pool is not None:
+        with tracing.start_span('parallel decode'):
+            # Multi-field messages show up as several messages at the same offset
+            by_offset = collections.OrderedDict()
+            for msg in grib:
+                by_offset.setdefault(msg['offset'], []).append(msg)
+
+            grib = GribIndex(msg for chunk in decode_in_pool(decode_pool, [
+                (msgs, decode_file_chunk_into, (file_path, offset, msgs[0]['totalLength'], len(msgs) > 1))
+                for offset, msgs in by_offset.items()
+            ]) for msg in chunk)
+
+    ingest_grib(grib, source, memory_budget)
+
+
+def ingest_grib(grib, source, memory_budget=None):
+    """
+    Ingests already read GRIB messages into the backend.
+    :param grib: GribIndex of the messages to ingest
+    :param source: Source object which denotes which source this data is from
+    :param memory_budget: Max bytes of decoded data to hold before flushing to the backend (None for no limit)
+    :return: None
+    """
+    save_grib_fields(collect_grib_fields(grib, source, flush=save_grib_fields, memory_budget=memory_budget))
+
+
+def _new_fields():
+    return collections.defaultdict(lambda: collections.defaultdict(list))
+
+
+def collect_grib_fields(grib, source, flush=None, memory_budget=None, field_ids=None):
+    """
+    Gathers the values (as float32) of every field of source (including derived fields) in grib.
+    :param grib: GribIndex of the messages to ingest
+    :param source: Source object which denotes which source this data is from
+    :param field_ids: Only gather these SourceFields (e.g. one field group of an item). Derived fields are only
+                      generated if this includes their inputs (see split_field_groups).
+    :param flush: Called with the fields gathered so far once they take more than memory_budget bytes,
+                  after which they are dropped. Fields are only flushed whole, so all members stay together.
+    :param memory_budget: Max bytes of values to hold before calling flush
+    :return: Map of projection id to map of {(field_id, valid_time, run_time) -> [values, ...]} not yet flushed
+    """
+    data_by_projection = _new_fields()
+    held_bytes = 0
+    peak_bytes = 0
+    # ru_maxrss is the peak over the life of the process (in KiB on Linux), so only its growth is due to this call
+    start_peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
-    # Keeps all data points that we'll be inserting at the end.
-    # Map of projection to map of {(field_id, valid_time, run_time) -> [msg, ...]}
-    data_by_projection = collections.defaultdict(lambda: collections.defaultdict(list))
+    fields = SourceField.query.filter(SourceField.source_id == source.id, SourceField.metric.has(Metric.intermediate == False))
+    if field_ids is not None:
+        fields = fields.filter(SourceField.id.in_(field_ids))
 
-    for field in SourceField.query.filter(SourceField.source_id == source.id, SourceField.metric.has(Metric.intermediate == False)).all():
+    for field in fields.all():
         try:
             msgs = grib.select(**field.selectors)
         except ValueError:
@@ -133,17 +546,63 @@ def ingest_grib_file(file_path, source):
                     db.session.commit()
 
                 valid_date = get_end_valid_time(msg)
-                data_by_projection[field.projection][(field.id, valid_date, msg.analDate)].append(msg.values)
+                values = normalize(msg.values, message_units(msg), metric_units(field.metric))
+                data_by_projection[field.projection_id][(field.id, valid_date, msg.analDate)].append(values)
+                held_bytes += values.nbytes
 
-    with tracing.start_span('generate derived'):
-        logger.info("Generating derived fields")
-        for proj, fields in get_source_module(source.short_name).generate_derived(grib).items():
-            for k, v in fields.items():
-                data_by_projection[proj][k].extend(v)
+        peak_bytes = max(peak_bytes, held_bytes)
+
+        if flush is not None and memory_budget is not None and held_bytes >= memory_budget:
+            logger.info("Flushing %d bytes of fields to stay within memory budget", held_bytes)
+            flush(data_by_projection)
+            data_by_projection = _new_fields()
+            held_bytes = 0
+
+    # Only the first field group has the inputs (and outputs) of derived fields, see split_field_groups
+    if field_ids is None or any(field_id in field_ids for field_id in derivation_input_field_ids(source)):
+        with tracing.start_span('generate derived'):
+            logger.info("Generating derived fields")
+            for proj, derived in get_source_module(source.short_name).generate_derived(grib).items():
+                for k, v in derived.items():
+                    data_by_projection[proj.id][k].extend(val.astype(numpy.float32, copy=False) for val in v)
+
+    with tracing.start_span('generate synthesized'):
+        for proj_id, synthesized in get_source_module(source.short_name).generate_synthesized(grib).items():
+            for k, v in synthesized.items():
+                data_by_projection[proj_id][k].extend(v)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    logger.info("Peak held field data %.1f MiB, process lifetime peak RSS %.1f MiB (raised %.1f MiB by this ingest)",
+                peak_bytes / 2**20, peak_rss / 2**10, (peak_rss - start_peak_rss) / 2**10)
+
+    return data_by_projection
+
+
+def save_grib_fields(data_by_projection):
+    """
+    Saves fields gathered by collect_grib_fields to the storage backend.
+    """
+    with tracing.start_span('rollups'):
+        rollups = rollup_fields(data_by_projection)
 
     with tracing.start_span('save denormalized'):
         logger.info("Saving denormalized location/time data for all messages")
-        for proj, fields in data_by_projection.items():
-            storage.get_provider().put_fields(proj, fields)
+        for proj_id in set(data_by_projection) | set(rollups):
+            fields = {**data_by_projection.get(proj_id, {}), **rollups.get(proj_id, {})}
+            storage.get_provider().put_fields(Projection.query.get(proj_id), fields)
+
+    grid_store = get_grid_store()
+    if grid_store is not None:
+        with tracing.start_span('save grids'):
+            # Only fields of real sources; synthesized ones (e.g. nowcasts) aren't inputs to grid jobs
+            field_ids = {field_id for fields in data_by_projection.values() for field_id, _, _ in fields.keys()}
+            grid_field_ids = {
+                sf.id for sf in SourceField.query.filter(SourceField.id.in_(field_ids)).all()
+                if sf.selectors is not None
+            }
+            for fields in data_by_projection.values():
+                for (field_id, valid_time, run_time), members in fields.items():
+                    if field_id in grid_field_ids:
+                        grid_store.put(field_id, run_time, valid_time, members)
 
     logger.info("Done saving denormalized data")
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Counts the passes over a GRIB file, and the select calls, made by ingest's field and derived lookups: reading
+with pygrib directly (as ingest did before GribIndex, where every select rescans the file) and through GribIndex.
+"""
+import argparse
+import logging
+import pygrib
+import time
+
+from wx_explore.common.models import Metric, Source, SourceField
+from wx_explore.ingest.common import get_source_module
+from wx_explore.ingest.grib import GribIndex
+from wx_explore.web.core import app
+
+
+class CountingGrib(object):
+    """
+    Wraps a pygrib.open or GribIndex, counting select calls and passes over its messages.
+    Every pygrib select rewinds and reads every message, so counts as a pass.
+    """
+
+    def __init__(self, grib, select_is_pass):
+        self.grib = grib
+        self.select_is_pass = select_is_pass
+        self.n_selects = 0
+        self.n_passes = 0
+
+    def __iter__(self):
+        self.n_passes += 1
+        if hasattr(self.grib, 'seek'):
+            self.grib.seek(0)
+        return iter(self.grib)
+
+    def select(self, **selectors):
+        self.n_selects += 1
+        if self.select_is_pass:
+            self.n_passes += 1
+        return self.grib.select(**selectors)
+
+
+def lookup_fields(grib, source):
+    """
+    Makes the lookups collect_grib_fields does: each field's selectors, then the derived fields' inputs.
+    Like an ingest of the file, generate_derived records the projections of the derived fields.
+    """
+    fields = SourceField.query.filter(SourceField.source_id == source.id, SourceField.metric.has(Metric.intermediate == False))
+    for field in fields.all():
+        if field.selectors is None:
+            continue
+        try:
+            grib.select(**field.selectors)
+        except ValueError:
+            pass
+
+    get_source_module(source.short_name).generate_derived(grib)
+
+
+def run_pygrib(file_path, source):
+    grib = CountingGrib(pygrib.open(file_path), select_is_pass=True)
+    lookup_fields(grib, source)
+    return grib.n_passes, grib.n_selects
+
+
+def run_index(file_path, source):
+    f = CountingGrib(pygrib.open(file_path), select_is_pass=True)
+    grib = CountingGrib(GribIndex(f), select_is_pass=False)
+    lookup_fields(grib, source)
+    return f.n_passes + grib.n_passes, grib.n_selects
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description='Count GRIB passes and selects per ingested file, with and without GribIndex')
+    parser.add_argument('file', help='GRIB file, e.g. one reduced by reduce_grib')
+    parser.add_argument('source', help='Short name of the source the file is from (e.g. hrrr)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        source = Source.query.filter_by(short_name=args.source).first()
+        if source is None:
+            raise ValueError(f"Unknown source {args.source}")
+
+        for name, func in [('pygrib (previous)', run_pygrib), ('GribIndex', run_index)]:
+            t0 = time.perf_counter()
+            n_passes, n_selects = func(args.file, source)
+            elapsed = time.perf_counter() - t0
+            print(f"{name}: {n_passes} passes over the file, {n_selects} selects, {elapsed * 1000:.2f} ms")
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Runs the jobs which work on the grid store's grids: the model blend, then the daily aggregates made from it.
+Queue workers run these after storing new grids (see IngestPipeline), or this can be run on a schedule.
+"""
+import argparse
+import logging
+
+from wx_explore.common import tracing
+from wx_explore.common.log_setup import init_sentry
+from wx_explore.common.tracing import init_tracing
+from wx_explore.ingest.blend import blend_models
+from wx_explore.ingest.daily import aggregate_days
+from wx_explore.web.core import app
+
+
+def run_grid_jobs(hours_ahead=240, days=10):
+    with tracing.start_span('blend models'):
+        blend_models(hours_ahead)
+    # Daily aggregates are made from the blend, so are refreshed whenever it is
+    with tracing.start_span('aggregate days'):
+        aggregate_days(days)
+
+
+if __name__ == "__main__":
+    init_sentry()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Blend models and compute daily aggregates of the blend')
+    parser.add_argument('--hours', type=int, default=240, help='Number of hours ahead to blend')
+    parser.add_argument('--days', type=int, default=10, help='Number of days to aggregate')
+    args = parser.parse_args()
+
+    init_tracing('grid_jobs')
+    with app.app_context():
+        run_grid_jobs(args.hours, args.days)
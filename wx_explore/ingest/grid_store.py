@@ -0,0 +1,116 @@
+"""
+Local store of the latest full grid of each (source field, valid time), written as fields are ingested.
+
+The storage backends are laid out for point lookups, so jobs which work on whole grids (model blends,
+rollups, daily aggregates) read from here instead. Only the newest run of each valid time is kept.
+"""
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import logging
+import numpy
+import os
+import tempfile
+import threading
+
+from wx_explore.common.config import Config
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y%m%dT%H%M'
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class GridStore(object):
+    root: str
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _field_dir(self, field_id):
+        return os.path.join(self.root, str(field_id))
+
+    def _entries(self, field_id):
+        """
+        :return: List of (valid_time, run_time, path) for the field
+        """
+        field_dir = self._field_dir(field_id)
+        if not os.path.isdir(field_dir):
+            return []
+
+        entries = []
+        for name in os.listdir(field_dir):
+            if name.startswith('.') or not name.endswith('.npy'):
+                continue
+            valid, run = name[:-len('.npy')].split('_')
+            entries.append((datetime.strptime(valid, TIME_FORMAT), datetime.strptime(run, TIME_FORMAT), os.path.join(field_dir, name)))
+        return entries
+
+    def put(self, field_id, run_time, valid_time, members: List[numpy.ndarray]):
+        """
+        Stores the grid (all members) of a field at a valid time, unless a newer run of it is already stored.
+        """
+        field_dir = self._field_dir(field_id)
+        os.makedirs(field_dir, exist_ok=True)
+
+        with self.lock:
+            existing = [(run, path) for valid, run, path in self._entries(field_id) if valid == valid_time]
+            if any(run > run_time for run, _ in existing):
+                return
+
+            fd, tmp_path = tempfile.mkstemp(prefix='.', dir=field_dir)
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, numpy.stack(members).astype(numpy.float32, copy=False))
+            os.replace(tmp_path, os.path.join(field_dir, f"{valid_time.strftime(TIME_FORMAT)}_{run_time.strftime(TIME_FORMAT)}.npy"))
+
+            for run, path in existing:
+                if run != run_time:
+                    os.unlink(path)
+
+    def get(self, field_id, valid_time) -> Optional[Tuple[datetime, numpy.ndarray]]:
+        """
+        :return: (run time, [member, y, x] float32 array (memory mapped)) of the newest run stored, or None
+        """
+        for valid, run, path in self._entries(field_id):
+            if valid == valid_time:
+                try:
+                    return run, numpy.load(path, mmap_mode='r')
+                except FileNotFoundError:
+                    # Replaced by a newer run while listing
+                    return self.get(field_id, valid_time)
+        return None
+
+    def valid_times(self, field_id, start: datetime, end: datetime) -> List[datetime]:
+        """
+        :return: Sorted valid times in [start, end) which the field has a grid for
+        """
+        return sorted(valid for valid, _, _ in self._entries(field_id) if start <= valid < end)
+
+    def clean(self, oldest_time: datetime):
+        """
+        Removes grids valid before oldest_time.
+        """
+        if not os.path.isdir(self.root):
+            return
+
+        for field_id in os.listdir(self.root):
+            for valid, _, path in self._entries(field_id):
+                if valid < oldest_time:
+                    os.unlink(path)
+
+
+def get_grid_store() -> Optional[GridStore]:
+    """
+    :return: The process-wide GridStore, or None if it is disabled
+    """
+    global _store
+    if not Config.INGEST_GRID_DIR:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = GridStore(Config.INGEST_GRID_DIR)
+        return _store
@@ -0,0 +1,71 @@
+"""
+Nowcasting: fills in the minutes between a source's (sub-hourly) forecast frames using optical flow,
+stored as a synthesized source.
+"""
+from datetime import timedelta
+from typing import Dict, List
+
+import collections
+import logging
+
+from wx_explore.analysis.interpolate import interpolate
+from wx_explore.common.models import Metric, Source
+from wx_explore.ingest.common import get_or_create_synthesized_field
+from wx_explore.ingest.grib import get_end_valid_time
+from wx_explore.ingest.units import message_units, metric_units, normalize
+
+logger = logging.getLogger(__name__)
+
+NOWCAST_SOURCE = 'nowcast'
+NOWCAST_SOURCE_NAME = 'Nowcast (optical flow)'
+
+# Spacing of nowcast frames
+STEP = timedelta(minutes=1)
+
+
+def nowcast_fields(grib, source: Source, nowcast_metrics: List[Metric], max_lead: timedelta) -> Dict:
+    """
+    Interpolates frames every STEP between consecutive messages (of the same run) of each of source's
+    fields for nowcast_metrics in grib.
+    :param grib: GribIndex of the file being ingested
+    :param max_lead: Only interpolate between messages up to this long after their run time
+    :return: Map of projection id to map of {(field_id, valid_time, run_time) -> [values]}
+    """
+    fields_by_metric = {sf.metric_id: sf for sf in source.fields}
+    data_by_projection = collections.defaultdict(dict)
+
+    for metric in nowcast_metrics:
+        sf = fields_by_metric.get(metric.id)
+        if sf is None or sf.selectors is None or sf.projection_id is None:
+            continue
+
+        try:
+            msgs = grib.select(**sf.selectors)
+        except ValueError:
+            continue
+
+        nowcast_sf = get_or_create_synthesized_field(NOWCAST_SOURCE, NOWCAST_SOURCE_NAME, metric, sf.projection_id)
+
+        frames_by_run = collections.defaultdict(list)
+        for msg in msgs:
+            valid_time = get_end_valid_time(msg)
+            if valid_time - msg.analDate <= max_lead:
+                frames_by_run[msg.analDate].append((valid_time, msg))
+
+        for run_time, frames in frames_by_run.items():
+            frames.sort(key=lambda f: f[0])
+            for (time_a, msg_a), (time_b, msg_b) in zip(frames, frames[1:]):
+                steps = int((time_b - time_a) / STEP)
+                if steps < 2:
+                    continue
+
+                logger.info("Nowcasting %s from %s to %s", metric.name, time_a, time_b)
+                interpolated = interpolate(
+                    normalize(msg_a.values, message_units(msg_a), metric_units(metric)),
+                    normalize(msg_b.values, message_units(msg_b), metric_units(metric)),
+                    steps,
+                )
+                for i, frame in enumerate(interpolated, 1):
+                    data_by_projection[sf.projection_id][(nowcast_sf.id, time_a + STEP * i, run_time)] = [frame]
+
+    return data_by_projection
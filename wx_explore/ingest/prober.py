@@ -0,0 +1,127 @@
+"""
+Checks whether queued GRIBs have been published yet, and learns how long after its run time each forecast
+hour of a source is usually published so items can be scheduled for when they should be available.
+"""
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from sqlalchemy.dialects.postgresql import insert
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import concurrent.futures
+import logging
+
+from wx_explore.common.models import PublishDelay, Source
+from wx_explore.common.utils import get_session
+from wx_explore.web.core import db
+
+logger = logging.getLogger(__name__)
+
+# Weight of a new observation in the moving average of a forecast hour's publish delay
+DELAY_ALPHA = 0.3
+
+# Observed delays beyond this are ignored, e.g. files which were re-uploaded long after their run
+MAX_DELAY = timedelta(days=1)
+
+# How soon to check again for an item that should already have been published
+LATE_RETRY = timedelta(minutes=5)
+
+
+def forecast_hour(req) -> int:
+    return (req['valid_time'] - req['run_time']) // 3600
+
+
+def get_publish_delays(source_name) -> Dict[int, float]:
+    """
+    :return: Map of forecast hour -> learned publish delay (in seconds after the run time) for the source
+    """
+    q = PublishDelay.query.join(Source).filter(Source.short_name == source_name)
+    return {d.forecast_hour: d.delay for d in q.all()}
+
+
+def get_schedule(source_name, run_time: datetime, hours: Iterable[int], default_delay: timedelta) -> Dict[int, datetime]:
+    """
+    :param default_delay: Delay to use for forecast hours which haven't been observed yet
+    :return: Map of forecast hour -> time it is expected to be published
+    """
+    delays = get_publish_delays(source_name)
+    return {
+        hr: run_time + (timedelta(seconds=delays[hr]) if hr in delays else default_delay)
+        for hr in hours
+    }
+
+
+def record_publish_delays(source: Source, observations: Dict[int, float]):
+    """
+    Folds observed publish delays (forecast hour -> seconds after the run time) into the learned averages.
+    """
+    if not observations:
+        return
+
+    table = PublishDelay.__table__
+    for hr, delay in observations.items():
+        stmt = insert(table).values(source_id=source.id, forecast_hour=hr, delay=delay, n_observations=1)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['source_id', 'forecast_hour'],
+            set_={
+                'delay': (1 - DELAY_ALPHA) * table.c.delay + DELAY_ALPHA * stmt.excluded.delay,
+                'n_observations': table.c.n_observations + 1,
+            },
+        ))
+    db.session.commit()
+
+
+def _published_at(url) -> Tuple[bool, Optional[datetime]]:
+    """
+    :return: Whether url exists, and when it was last modified if the server says
+    """
+    try:
+        r = get_session().head(url, allow_redirects=True, timeout=30)
+    except Exception:
+        logger.warning("Unable to check %s", url, exc_info=True)
+        return False, None
+
+    if not 200 <= r.status_code < 400:
+        return False, None
+
+    last_modified = r.headers.get('Last-Modified')
+    if last_modified is None:
+        return True, None
+    return True, parsedate_to_datetime(last_modified).replace(tzinfo=None)
+
+
+def probe(source: Source, reqs: List[dict], n_workers=16) -> Tuple[List[dict], List[Tuple[dict, datetime]]]:
+    """
+    Checks which of the given items (all from source) have been published, all at once.
+    Only idx files are checked since they are written after their GRIB.
+    Publish times of found items are recorded to improve future schedules.
+    :return: List of available items, and list of (missing item, when to check it again)
+    """
+    with concurrent.futures.ThreadPoolExecutor(min(n_workers, len(reqs))) as ex:
+        results = list(ex.map(lambda req: _published_at(req['idx_url']), reqs))
+
+    now = datetime.utcnow()
+    delays = get_publish_delays(source.short_name)
+
+    available = []
+    missing = []
+    observations = {}
+    for req, (exists, published_at) in zip(reqs, results):
+        hr = forecast_hour(req)
+        if exists:
+            available.append(req)
+            if published_at is not None:
+                delay = published_at - datetime.utcfromtimestamp(req['run_time'])
+                if timedelta(0) <= delay <= MAX_DELAY:
+                    observations[hr] = delay.total_seconds()
+            continue
+
+        # Wait until it's expected to be published, or a little while if it's already late
+        expected = datetime.utcfromtimestamp(req['run_time']) + timedelta(seconds=delays.get(hr, 0))
+        if expected > now:
+            missing.append((req, max(expected, now + timedelta(minutes=1))))
+        else:
+            missing.append((req, now + LATE_RETRY))
+
+    record_publish_delays(source, observations)
+
+    return available, missing
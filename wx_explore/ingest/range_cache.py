@@ -0,0 +1,126 @@
+"""
+Local disk cache of byte ranges downloaded from remote GRIBs.
+
+Entries are content-addressed by (URL, remote version, start, length), where the version is the ETag of
+the file's .idx (which is re-published along with it), so a re-published file never serves stale bytes. Retries and re-ingests of the same file hit the
+cache instead of downloading from NOMADS again. Least recently used entries are evicted once the cache
+grows past its size limit.
+"""
+from typing import Optional
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from wx_explore.common.config import Config
+
+logger = logging.getLogger(__name__)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class RangeCache(object):
+    cache_dir: str
+    max_bytes: int
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self):
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith('.'):
+                yield os.path.join(self.cache_dir, name)
+
+    def _path(self, url, version, start, length):
+        key = hashlib.sha256(f"{url}\n{version}\n{start}\n{length}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, url, version, start, length) -> Optional[bytes]:
+        path = self._path(url, version, start, length)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mtime is used as the last use time for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        if len(data) != length:
+            logger.warning("Discarding truncated cache entry for %s bytes %d-%d", url, start, start+length-1)
+            self._remove(path)
+            return None
+
+        return data
+
+    def put(self, url, version, start, length, data):
+        if len(data) != length or length > self.max_bytes:
+            return
+
+        path = self._path(url, version, start, length)
+        # Write to a hidden temp file then rename so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_bytes += length
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.total_bytes -= size
+
+    def _evict(self):
+        """
+        Removes least recently used entries until the cache is at most 90% of max_bytes.
+        Must be called with self.lock held.
+        """
+        entries = []
+        for path in self._entries():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        # Recount from disk, since concurrent puts of the same range are counted twice
+        self.total_bytes = sum(size for _, size, _ in entries)
+        target = 0.9 * self.max_bytes
+
+        for _, size, path in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+
+def get_range_cache() -> Optional[RangeCache]:
+    """
+    :return: The process-wide RangeCache, or None if the cache is disabled
+    """
+    global _cache
+    if not Config.INGEST_RANGE_CACHE_DIR or Config.INGEST_RANGE_CACHE_SIZE <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = RangeCache(Config.INGEST_RANGE_CACHE_DIR, Config.INGEST_RANGE_CACHE_SIZE)
+        return _cache
@@ -0,0 +1,101 @@
+"""
+Hourly rollups of sub-hourly sources: the frames of each field within an hour are reduced to their mean,
+min and max, each stored as a synthesized source (see storage.ROLLUP_STATS), so readers which only need
+hourly data read a quarter of the points.
+"""
+from datetime import timedelta
+from typing import Dict, List
+
+import collections
+import logging
+import numpy
+import warnings
+
+from wx_explore.common import metrics
+from wx_explore.common.models import SourceField
+from wx_explore.common.storage import rollup_source_name
+from wx_explore.ingest.common import get_or_create_synthesized_field, get_source_module
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_STEP = timedelta(hours=1)
+
+# Angles can't be averaged (or ordered) like other values, so only get a circular mean
+CIRCULAR_METRICS = {metrics.wind_direction.id}
+
+
+def hour_end(valid_time):
+    """
+    :return: The end of the hour valid_time is in, with hours covering (hh:00, hh+1:00]
+    """
+    hour = valid_time.replace(minute=0, second=0, microsecond=0)
+    if hour != valid_time:
+        hour += ROLLUP_STEP
+    return hour
+
+
+def _reduce(frames: List[numpy.ndarray], metric) -> Dict[str, numpy.ndarray]:
+    """
+    :return: Map of stat -> values over the frames (every member of every frame in the hour)
+    """
+    stack = numpy.stack(frames)
+
+    with warnings.catch_warnings():
+        # Cells which are NaN in every frame stay NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        if metric.id in CIRCULAR_METRICS:
+            rad = numpy.radians(stack)
+            mean = numpy.degrees(numpy.arctan2(numpy.nanmean(numpy.sin(rad), axis=0), numpy.nanmean(numpy.cos(rad), axis=0)))
+            return {'mean': numpy.mod(mean, 360).astype(numpy.float32, copy=False)}
+
+        stats = {
+            'min': numpy.nanmin(stack, axis=0),
+            'max': numpy.nanmax(stack, axis=0),
+        }
+        if metric.units == '':
+            # Flags (e.g. raining): whether it happened at any point in the hour
+            stats['mean'] = stats['max']
+        else:
+            stats['mean'] = numpy.nanmean(stack, axis=0)
+
+    return {stat: values.astype(numpy.float32, copy=False) for stat, values in stats.items()}
+
+
+def rollup_fields(data_by_projection) -> Dict:
+    """
+    Computes hourly rollups of the fields (of sources with ROLLUP_HOURLY set) in data_by_projection.
+    Every frame of an hour must be in data_by_projection, which holds as each ingested file has whole hours.
+    :param data_by_projection: Map of projection id to map of {(field_id, valid_time, run_time) -> [values]}
+    :return: Map of projection id to map of {(field_id, valid_time, run_time) -> [values]} of the rollups
+    """
+    source_fields = {}
+    hours = collections.defaultdict(list)
+    for proj_id, fields in data_by_projection.items():
+        for (field_id, valid_time, run_time), members in fields.items():
+            if field_id not in source_fields:
+                source_fields[field_id] = SourceField.query.get(field_id)
+            sf = source_fields[field_id]
+
+            # Synthesized fields (e.g. nowcasts) aren't rolled up
+            if sf.selectors is None or not get_source_module(sf.source.short_name).ROLLUP_HOURLY:
+                continue
+
+            hours[(proj_id, field_id, hour_end(valid_time), run_time)].extend(members)
+
+    rollups = collections.defaultdict(dict)
+    for (proj_id, field_id, hour, run_time), frames in hours.items():
+        sf = source_fields[field_id]
+        for stat, values in _reduce(frames, sf.metric).items():
+            rollup_sf = get_or_create_synthesized_field(
+                rollup_source_name(sf.source.short_name, stat),
+                f"{sf.source.name} (hourly {stat})",
+                sf.metric,
+                proj_id,
+            )
+            rollups[proj_id][(rollup_sf.id, hour, run_time)] = [values]
+
+    if rollups:
+        logger.info("Rolled up %d field hours", len(hours))
+
+    return rollups
@@ -7,7 +7,8 @@ import logging
 
 from wx_explore.common.log_setup import init_sentry
 from wx_explore.common.utils import datetime2unix
-from wx_explore.ingest.common import get_queue
+from wx_explore.ingest.common import get_queue, ingest_priority
+from wx_explore.ingest.prober import get_schedule
 from wx_explore.ingest.sources.source import IngestSource
 
 
@@ -29,9 +30,10 @@ class GFS(IngestSource):
             run_time = run_time.replace(hour=(run_time.hour//6)*6, minute=0, second=0, microsecond=0)
 
         if acquire_time is None:
-            # the first files are available 3.5hr after
-            acquire_time = run_time
-            acquire_time += timedelta(hours=3, minutes=30)
+            # the first files are available 3.5hr after. Later hours are scheduled as they were published in previous runs.
+            schedule = get_schedule(GFS.SOURCE_NAME, run_time, times, timedelta(hours=3, minutes=30))
+        else:
+            schedule = {hr: acquire_time for hr in times}
 
         base_url = run_time.strftime("https://noaa-gfs-bdp-pds.s3.amazonaws.com/gfs.%Y%m%d/%H/atmos/gfs.t%Hz.pgrb2.0p25.f{}")
 
@@ -44,7 +46,8 @@ class GFS(IngestSource):
                 "run_time": datetime2unix(run_time),
                 "url": url,
                 "idx_url": url+".idx",
-            }, schedule_at=acquire_time)
+                "priority": ingest_priority("gfs", hr),
+            }, schedule_at=schedule[hr])
 
 
 if __name__ == "__main__":
@@ -5,9 +5,12 @@ from typing import Optional
 import argparse
 import logging
 
+from wx_explore.common import metrics
+from wx_explore.common.config import Config
 from wx_explore.common.log_setup import init_sentry
 from wx_explore.common.utils import datetime2unix
-from wx_explore.ingest.common import get_queue
+from wx_explore.ingest.common import get_queue, ingest_priority
+from wx_explore.ingest.prober import get_schedule
 from wx_explore.ingest.sources.source import IngestSource
 
 logger = logging.getLogger(__name__)
@@ -15,6 +18,23 @@ logger = logging.getLogger(__name__)
 
 class HRRR(IngestSource):
     SOURCE_NAME = "hrrr"
+    ROLLUP_HOURLY = True
+
+    # Metrics whose 15 minute frames are interpolated into 1 minute nowcast frames
+    NOWCAST_METRICS = [metrics.composite_reflectivity]
+
+    @classmethod
+    def generate_synthesized(cls, grib):
+        if Config.INGEST_NOWCAST_HOURS <= 0:
+            return {}
+
+        try:
+            from wx_explore.ingest.nowcast import nowcast_fields
+        except ImportError:
+            logger.warning("OpenCV is not installed, skipping nowcast")
+            return {}
+
+        return nowcast_fields(grib, cls.get_db_source(), cls.NOWCAST_METRICS, timedelta(hours=Config.INGEST_NOWCAST_HOURS))
 
     @staticmethod
     def queue(
@@ -27,15 +47,18 @@ class HRRR(IngestSource):
             # hrrr is run each hour
             run_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
 
+        hours = range(time_min, time_max + 1)
+
         if acquire_time is None:
-            # first files are available about 45 mins after
-            acquire_time = run_time
-            acquire_time += timedelta(minutes=45)
+            # first files are available about 45 mins after. Later hours are scheduled as they were published in previous runs.
+            schedule = get_schedule(HRRR.SOURCE_NAME, run_time, hours, timedelta(minutes=45))
+        else:
+            schedule = {hr: acquire_time for hr in hours}
 
         base_url = run_time.strftime("https://nomads.ncep.noaa.gov/pub/data/nccf/com/hrrr/prod/hrrr.%Y%m%d/conus/hrrr.t%Hz.wrfsubhf{}.grib2")
 
         q = get_queue()
-        for hr in range(time_min, time_max + 1):
+        for hr in hours:
             url = base_url.format(str(hr).zfill(2))
             q.put({
                 "source": "hrrr",
@@ -43,7 +66,8 @@ class HRRR(IngestSource):
                 "run_time": datetime2unix(run_time),
                 "url": url,
                 "idx_url": url+".idx",
-            }, schedule_at=acquire_time)
+                "priority": ingest_priority("hrrr", hr),
+            }, schedule_at=schedule[hr])
 
 
 if __name__ == "__main__":
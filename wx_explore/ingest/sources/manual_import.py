@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 import sys
 import logging
-import tempfile
 
-from wx_explore.ingest.grib import get_grib_ranges, ingest_grib_file
+from wx_explore.ingest.decode import read_grib_bytes
+from wx_explore.ingest.grib import (
+    DEFAULT_MEMORY_BUDGET,
+    GribIndex,
+    get_grib_ranges,
+    get_idx,
+    get_idx_version,
+    get_multi_field_offsets,
+    ingest_grib,
+    parse_idx,
+    stream_ranges,
+)
 from wx_explore.common.log_setup import init_sentry
 from wx_explore.common.models import Source
 
@@ -17,7 +27,7 @@ logging.getLogger('botocore').setLevel(logging.INFO)
 logging.getLogger('nose').setLevel(logging.INFO)
 
 if len(sys.argv) < 3:
-    print(f"Usage: {sys.argv[0]} source_short_name files...", file=sys.stderr)
+    print(f"Usage: {sys.argv[0]} source_short_name files_or_urls...", file=sys.stderr)
     sys.exit(1)
 
 # E.g. "hrrr"
@@ -29,16 +39,31 @@ src = Source.query.filter_by(short_name=src_name).first()
 if src is None:
     raise Exception(f"Invalid source {src_name}")
 
+
+def read_local_ranges(path, ranges):
+    with open(path, 'rb') as src_grib:
+        for offset, length in ranges:
+            src_grib.seek(offset)
+            yield offset, src_grib.read(length)
+
+
 for f in files:
-    with open(f + '.idx', 'r') as index:
-        ranges = get_grib_ranges(index.read(), src.fields)
+    is_url = f.startswith(('http://', 'https://'))
+
+    if is_url:
+        idx = get_idx(f + '.idx')
+    else:
+        with open(f + '.idx', 'r') as index:
+            idx = parse_idx(index.read())
+    ranges = get_grib_ranges(idx, src.fields)
+    multi_field_offsets = get_multi_field_offsets(idx)
 
-    with tempfile.NamedTemporaryFile() as reduced:
-        with open(f, 'rb') as src_grib:
-            for offset, length in ranges:
-                src_grib.seek(offset)
-                reduced.write(src_grib.read(length))
+    # Remote files go through the range cache, so re-importing them doesn't download them again
+    chunks = sorted(stream_ranges(f, ranges, version=get_idx_version(f + '.idx'))) if is_url else read_local_ranges(f, ranges)
 
-            reduced.flush()
+    msgs = []
+    for offset, data in chunks:
+        # Values are decoded lazily, so only what ingest_grib holds before flushing is in memory
+        msgs.extend(read_grib_bytes(data, offset in multi_field_offsets))
 
-            ingest_grib_file(reduced.name, src)
+    ingest_grib(GribIndex(msgs), src, DEFAULT_MEMORY_BUDGET)
@@ -7,7 +7,8 @@ import logging
 
 from wx_explore.common.log_setup import init_sentry
 from wx_explore.common.utils import datetime2unix
-from wx_explore.ingest.common import get_queue
+from wx_explore.ingest.common import get_queue, ingest_priority
+from wx_explore.ingest.prober import get_schedule
 from wx_explore.ingest.sources.source import IngestSource
 
 
@@ -26,15 +27,18 @@ class NAM(IngestSource):
             run_time = datetime.utcnow()
             run_time = run_time.replace(hour=(run_time.hour//6)*6, minute=0, second=0, microsecond=0)
 
+        hours = range(time_min, time_max + 1)
+
         if acquire_time is None:
-            # the first files are available 1hr 45min after
-            acquire_time = run_time
-            acquire_time += timedelta(hours=1, minutes=45)
+            # the first files are available 1hr 45min after. Later hours are scheduled as they were published in previous runs.
+            schedule = get_schedule(NAM.SOURCE_NAME, run_time, hours, timedelta(hours=1, minutes=45))
+        else:
+            schedule = {hr: acquire_time for hr in hours}
 
         base_url = run_time.strftime("https://nomads.ncep.noaa.gov/pub/data/nccf/com/nam/prod/nam.%Y%m%d/nam.t%Hz.conusnest.hiresf{}.tm00.grib2")
 
         q = get_queue()
-        for hr in range(time_min, time_max + 1):
+        for hr in hours:
             url = base_url.format(str(hr).zfill(2))
             q.put({
                 "source": "nam",
@@ -42,7 +46,8 @@ class NAM(IngestSource):
                 "run_time": datetime2unix(run_time),
                 "url": url,
                 "idx_url": url+".idx",
-            }, schedule_at=acquire_time)
+                "priority": ingest_priority("nam", hr),
+            }, schedule_at=schedule[hr])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+"""
+Converts decoded fields from the units their source provides them in to the units of their metric,
+so values are stored (and served) in one unit per metric.
+"""
+from typing import Optional, Tuple
+
+import functools
+import logging
+import numpy
+
+from wx_explore.common.metrics import DECLARED_UNITS
+from wx_explore.common.models import Metric
+
+logger = logging.getLogger(__name__)
+
+# GRIB (eccodes) unit names -> the names used for Metric.units
+UNIT_ALIASES = {
+    'm s**-1': 'm/s',
+    'kg kg**-1': 'kg/kg',
+    'dB': 'dbZ',
+}
+
+# (from, to) -> (scale, offset), i.e. to = from * scale + offset
+CONVERSIONS = {
+    ('K', 'C'): (1.0, -273.15),
+    ('K', 'F'): (1.8, -459.67),
+    ('C', 'F'): (1.8, 32.0),
+    ('m/s', 'kt'): (1.943844, 0.0),
+    ('m/s', 'mph'): (2.236936, 0.0),
+    ('m/s', 'km/h'): (3.6, 0.0),
+    ('Pa', 'hPa'): (0.01, 0.0),
+    ('Pa', 'mb'): (0.01, 0.0),
+    ('m', 'km'): (0.001, 0.0),
+    ('m', 'mi'): (1 / 1609.344, 0.0),
+    ('kg/kg', 'g/kg'): (1000.0, 0.0),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_conversion(from_units: Optional[str], to_units: Optional[str]) -> Optional[Tuple[float, float]]:
+    """
+    :return: (scale, offset) converting from_units to to_units, or None if values should be left as they are
+             (same units, either is unknown, or there is no known conversion)
+    """
+    if not from_units or not to_units:
+        return None
+
+    from_units = UNIT_ALIASES.get(from_units, from_units)
+    if from_units == to_units:
+        return None
+
+    conversion = CONVERSIONS.get((from_units, to_units))
+    if conversion is None:
+        logger.warning("No conversion from %s to %s, storing values unconverted", from_units, to_units)
+    return conversion
+
+
+def metric_units(metric: Metric) -> str:
+    """
+    :return: The units values of metric are stored in
+    :raises Exception: If the database has other units for metric than it's declared with, since storing
+                       values in the declared units would mix them with those already stored
+    """
+    declared = DECLARED_UNITS.get(metric.name, metric.units)
+    if metric.units != declared:
+        raise Exception(f"{metric.name} is in {metric.units} in the database but declared in {declared}. "
+                        "Run wx_explore.common.migrate before ingesting.")
+    return declared
+
+
+def message_units(msg) -> Optional[str]:
+    return msg['units'] if msg.valid_key('units') else None
+
+
+def normalize(values, from_units, to_units) -> numpy.ndarray:
+    """
+    Converts values to to_units as float32. Values which need converting are written straight into a new
+    float32 array (no float64 temporaries); the input is never modified. Masked values become NaN either way.
+    """
+    if numpy.ma.isMaskedArray(values):
+        values = values.astype(numpy.float32, copy=False).filled(numpy.nan)
+
+    conversion = get_conversion(from_units, to_units)
+    if conversion is None:
+        return values.astype(numpy.float32, copy=False)
+
+    scale, offset = conversion
+    out = numpy.empty(values.shape, dtype=numpy.float32)
+    if scale != 1:
+        numpy.multiply(values, scale, out=out, casting='unsafe')
+        if offset != 0:
+            numpy.add(out, offset, out=out)
+    else:
+        numpy.add(values, offset, out=out, casting='unsafe')
+    return out
@@ -1,71 +1,567 @@
 #!/usr/bin/env python3
 from datetime import datetime, timedelta
+from typing import Callable, List, Optional
 
+import argparse
+import collections
+import concurrent.futures
 import logging
-import tempfile
+import queue
+import signal
+import threading
+import time
 
 from wx_explore.common import tracing
 from wx_explore.common.log_setup import init_sentry
 from wx_explore.common.models import Source
+from wx_explore.common.task_queue import LEASE
 from wx_explore.common.tracing import init_tracing
-from wx_explore.common.utils import url_exists
-from wx_explore.ingest.common import get_queue
-from wx_explore.ingest.grib import reduce_grib, ingest_grib_file
+from wx_explore.ingest.common import get_ingested_valid_times, get_queue, record_ingested, split_field_groups
+from wx_explore.ingest.grid_jobs import run_grid_jobs
+from wx_explore.ingest.grid_store import get_grid_store
+from wx_explore.ingest.prober import probe
+from wx_explore.ingest.grib import (
+    DEFAULT_MEMORY_BUDGET,
+    GribIndex,
+    collect_grib_fields,
+    decode_bytes_in_pool,
+    get_grib_ranges,
+    get_idx,
+    get_idx_version,
+    get_multi_field_offsets,
+    save_grib_fields,
+    stream_ranges,
+)
 from wx_explore.web.core import app, db
 
 logger = logging.getLogger(__name__)
 
+# Longest a long-lived worker waits on LISTEN/NOTIFY at once while holding the queue connection,
+# which bounds how long stages' re-queues and shutdown wait for it
+CLAIM_WAIT = 5
 
-def ingest_from_queue():
-    with app.app_context():
-        q = get_queue()
-        for ingest_req in q:
-            # Queue is empty for now
-            if ingest_req is None:
-                logger.info("Empty queue")
-                break
 
-            ingest_req = ingest_req.data
+class IngestJob(object):
+    """
+    A batch of queue items for the same source and run as it moves through the pipeline.
+    Items are downloaded and decoded individually but stored together.
+    """
+    reqs: List[dict]
+    # Queue ids of the items this job was claimed from, which are leased until the job is done
+    item_ids: List[int]
+    # Per req, (offset, bytes, multi_field) of each downloaded GRIB chunk
+    chunks: Optional[List[list]]
+    # Output of collect_grib_fields, merged across all reqs, less what was already flushed to storage
+    fields: Optional[dict]
+    # Map of requested valid time (of each req) -> ids of the fields decoded from its item. Messages' own
+    # valid times can differ (e.g. ends of averaging periods, sub-hourly frames), so this is kept per item.
+    stored: dict
+
+    def __init__(self, reqs, item_ids):
+        self.reqs = reqs
+        self.item_ids = item_ids
+        self.chunks = None
+        self.fields = None
+        self.stored = collections.defaultdict(set)
+
+    @property
+    def source(self) -> str:
+        return self.reqs[0]['source']
+
+    @property
+    def field_ids(self) -> Optional[List[int]]:
+        """
+        SourceField ids to ingest if this is a field group of its items, or None for all of the source's fields
+        """
+        return self.reqs[0].get('field_ids')
+
+    @property
+    def run_time(self) -> datetime:
+        return datetime.utcfromtimestamp(self.reqs[0]['run_time'])
+
+    def valid_times(self) -> List[datetime]:
+        return [datetime.utcfromtimestamp(req['valid_time']) for req in self.reqs]
+
+    def __repr__(self):
+        return f"<IngestJob source={self.source} run_time={self.reqs[0]['run_time']} n_items={len(self.reqs)}>"
+
+
+class Stage(object):
+    """
+    A pool of threads which take jobs from in_q, run func on each, and pass non-None results to out_q.
+    Jobs which don't make it to out_q (finished, dropped, or failed) are passed to on_done.
+    Tracks how much of its threads' time is spent doing work to help find pipeline bottlenecks.
+    """
+    STOP = object()
+
+    name: str
+    func: Callable[[IngestJob], Optional[IngestJob]]
+    on_error: Callable[[IngestJob], None]
+    on_done: Callable[[IngestJob], None]
+    n_workers: int
+    in_q: queue.Queue
+    out_q: Optional[queue.Queue]
+
+    def __init__(self, name, func, on_error, on_done, n_workers, in_q, out_q=None):
+        self.name = name
+        self.func = func
+        self.on_error = on_error
+        self.on_done = on_done
+        self.n_workers = n_workers
+        self.in_q = in_q
+        self.out_q = out_q
+
+        self.threads = []
+        self.lock = threading.Lock()
+        self.n_jobs = 0
+        self.busy_secs = 0.0
+        self.started_at = None
+
+    def start(self):
+        self.started_at = time.time()
+        for i in range(self.n_workers):
+            t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        """
+        Finishes all jobs already queued for this stage, then stops its threads.
+        """
+        for _ in self.threads:
+            self.in_q.put(self.STOP)
+        for t in self.threads:
+            t.join()
+
+    def _run(self):
+        # Each thread gets its own app context (and so its own DB session)
+        with app.app_context():
+            while True:
+                job = self.in_q.get()
+                if job is self.STOP:
+                    return
+
+                start = time.time()
+                try:
+                    with tracing.start_span(self.name) as span:
+                        span.set_attribute('source', job.source)
+                        span.set_attribute('run_time', job.reqs[0]['run_time'])
+                        span.set_attribute('n_items', len(job.reqs))
+                        res = self.func(job)
+                except Exception:
+                    logger.exception("Exception in %s stage while ingesting %s. Will retry", self.name, job)
+                    db.session.rollback()
+                    self.on_error(job)
+                    res = None
+                finally:
+                    with self.lock:
+                        self.n_jobs += 1
+                        self.busy_secs += time.time() - start
+
+                if res is not None and self.out_q is not None:
+                    self.out_q.put(res)
+                else:
+                    self.on_done(job)
+
+    def utilization(self) -> float:
+        elapsed = time.time() - self.started_at
+        return self.busy_secs / (elapsed * self.n_workers) if elapsed > 0 else 0.0
+
+    def stats(self) -> str:
+        return f"{self.name}: {self.n_jobs} jobs, {100*self.utilization():.0f}% busy, {self.in_q.qsize()} waiting"
+
+
+class IngestPipeline(object):
+    """
+    Ingests queue items through three stages connected by bounded queues, so that while one
+    batch is being stored the next ones are already downloading and decoding:
+
+        download (threads) -> decode (process pool, dispatched by threads) -> store (threads)
+
+    Ready items for the same source and run time are claimed together and stored as a single
+    batch, so each batch costs one put_fields per projection (and one DB commit) instead of one per item.
+
+    Claimed items are leased, and their leases are kept alive by a heartbeat until they're done, so any number
+    of workers (on any number of nodes) can share the queue and a crashed worker's items are picked up again
+    by others once their leases expire. With split_groups > 1, items claimed while the queue has nothing else
+    ready are split into that many field groups, and all but the first are put back for idle workers to take.
+
+    Each job holds at most memory_budget bytes of decoded fields; beyond that, the decode stage stores what it
+    has so far itself instead of passing it on.
+
+    With the grid store enabled, the grid jobs (blend and daily aggregates) are run at most every grid_jobs_interval
+    seconds while new grids have been stored, and once more before run returns.
+    """
+
+    def __init__(self, n_download=2, n_decode=2, n_decode_procs=None, n_store=2, queue_depth=2, batch_size=6, split_groups=1,
+                 memory_budget=DEFAULT_MEMORY_BUDGET, grid_jobs_interval=600):
+        self.q = get_queue()
+        # pq queues are a single connection, so serialize the claim loop and the stages' re-queues
+        self.q_lock = threading.Lock()
+        self.batch_size = batch_size
+        self.split_groups = split_groups
+        self.memory_budget = memory_budget
+        self.grid_jobs_interval = grid_jobs_interval
+        # Set when grids are stored, cleared when the grid jobs run
+        self._grids_changed = threading.Event()
+
+        # Queue ids of all items currently being worked on
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+
+        # Decode processes are forked, so start them all now before any stage threads exist
+        self.decode_pool = concurrent.futures.ProcessPoolExecutor(n_decode_procs)
+        self.decode_pool.submit(int).result()
+
+        download_q = queue.Queue(queue_depth * n_download)
+        decode_q = queue.Queue(queue_depth * n_decode)
+        store_q = queue.Queue(queue_depth * n_store)
+
+        self.stages = [
+            Stage('download', self.download, self.retry, self.finish, n_download, download_q, decode_q),
+            Stage('decode', self.decode, self.retry, self.finish, n_decode, decode_q, store_q),
+            Stage('store', self.store, self.retry, self.finish, n_store, store_q),
+        ]
+
+        self._report_stop = threading.Event()
+        self._stopping = threading.Event()
+
+        # Number of claimed items skipped because the manifest shows they were already ingested
+        self.n_skipped = 0
+        self.skipped_lock = threading.Lock()
+
+    def reschedule(self, reqs, delay):
+        """
+        :param delay: Interval (e.g. '4m') or datetime to retry the items at
+        """
+        with self.q_lock:
+            for req in reqs:
+                self.q.put(req, delay)
+
+    def retry(self, job):
+        self.reschedule(job.reqs, '4m')
+
+    def finish(self, job):
+        """
+        Releases the items a job was claimed from. Anything left to do for them has already been re-queued.
+        """
+        self.complete(job.item_ids)
+
+    def complete(self, item_ids):
+        with self.in_flight_lock:
+            self.in_flight.difference_update(item_ids)
+        with self.q_lock:
+            self.q.complete(item_ids)
+
+    def _heartbeat_loop(self):
+        while not self._report_stop.wait(LEASE.total_seconds() / 4):
+            with self.in_flight_lock:
+                item_ids = list(self.in_flight)
+            if not item_ids:
+                continue
+            try:
+                with self.q_lock:
+                    self.q.extend_leases(item_ids)
+            except Exception:
+                logger.exception("Unable to extend leases")
+
+    def _download_item(self, req, source_fields):
+        if req.get('field_ids') is not None:
+            source_fields = [sf for sf in source_fields if sf.id in req['field_ids']]
+
+        idx = get_idx(req['idx_url'])
+        multi_field_offsets = get_multi_field_offsets(idx)
+        return [
+            (offset, data, offset in multi_field_offsets)
+            for offset, data in stream_ranges(req['url'], get_grib_ranges(idx, source_fields), version=get_idx_version(req['idx_url']))
+        ]
+
+    def skip_ingested(self, job, source):
+        """
+        Drops items from job which were already ingested with all of source's fields.
+        """
+        done = get_ingested_valid_times(source, job.run_time, job.valid_times(), job.field_ids)
+        if not done:
+            return
+
+        skipped = [req for req in job.reqs if datetime.utcfromtimestamp(req['valid_time']) in done]
+        logger.info("Skipping %d already ingested items from %s %s", len(skipped), job.reqs[0]['run_time'], job.source)
+        with self.skipped_lock:
+            self.n_skipped += len(skipped)
+        job.reqs = [req for req in job.reqs if req not in skipped]
+
+    def download(self, job):
+        source = Source.query.filter_by(short_name=job.source).first()
+
+        self.skip_ingested(job, source)
+        if not job.reqs:
+            return None
+
+        # Items that aren't published yet are tried again when they're expected to be
+        available, missing = probe(source, job.reqs)
+        for req, retry_at in missing:
+            logger.info("Rescheduling request %s for %s", req, retry_at)
+            self.reschedule([req], retry_at)
+        if not available:
+            return None
+
+        job.reqs = available
+        source_fields = source.fields
+
+        logger.info("Downloading %d items from %s %s", len(job.reqs), job.reqs[0]['run_time'], source.short_name)
+        with concurrent.futures.ThreadPoolExecutor(len(job.reqs)) as ex:
+            job.chunks = list(ex.map(lambda req: self._download_item(req, source_fields), job.reqs))
+
+        return job
+
+    def decode(self, job):
+        source = Source.query.filter_by(short_name=job.source).first()
+
+        # Decode every chunk of every item together so the whole batch is spread across the pool
+        decoded = iter(decode_bytes_in_pool(self.decode_pool, [
+            (data, multi_field)
+            for chunks in job.chunks
+            for _, data, multi_field in chunks
+        ]))
+
+        job.fields = collections.defaultdict(lambda: collections.defaultdict(list))
+        held_bytes = 0
+
+        for valid_time, chunks in zip(job.valid_times(), job.chunks):
+            msgs = [msg for _ in chunks for msg in next(decoded)]
+            # Only fields which actually made it into the batch are recorded, so partially downloaded items aren't skipped later
+            item_field_ids = job.stored[valid_time]
+
+            def flush(fields):
+                item_field_ids.update(field_id for proj_fields in fields.values() for field_id, _, _ in proj_fields.keys())
+                save_grib_fields(fields)
+
+            collected = collect_grib_fields(
+                GribIndex(msgs),
+                source,
+                flush=flush,
+                memory_budget=self.memory_budget,
+                field_ids=job.field_ids,
+            )
+            for proj_id, fields in collected.items():
+                for k, v in fields.items():
+                    item_field_ids.add(k[0])
+                    job.fields[proj_id][k].extend(v)
+                    held_bytes += sum(values.nbytes for values in v)
+
+            # Items are flushed whole so each hour's frames are rolled up together
+            if self.memory_budget is not None and held_bytes >= self.memory_budget:
+                logger.info("Flushing %d bytes of fields of %s to stay within memory budget", held_bytes, job)
+                save_grib_fields(job.fields)
+                job.fields = collections.defaultdict(lambda: collections.defaultdict(list))
+                held_bytes = 0
+
+        # Raw bytes aren't needed anymore; don't hold them while waiting for the store stage
+        job.chunks = None
+
+        return job
+
+    def store(self, job):
+        save_grib_fields(job.fields)
+        job.fields = None
+
+        # Recorded only now that everything the job decoded (including anything flushed early) is stored
+        source = Source.query.filter_by(short_name=job.source).first()
+        record_ingested(source, job.run_time, {
+            valid_time: field_ids
+            for valid_time, field_ids in job.stored.items()
+            if field_ids
+        })
+        source.last_updated = datetime.utcnow()
+        db.session.commit()
+
+        self._grids_changed.set()
+
+        return None
+
+    def claim(self, timeout=None) -> Optional[List[IngestJob]]:
+        """
+        Claims the next ready item plus up to batch_size-1 more that are already ready,
+        grouped into batches by source and run time.
+        :param timeout: Max seconds to wait (on LISTEN/NOTIFY) for an item to be queued or become due
+        :return: List of batches, or None if nothing was ready within the timeout
+        """
+        with self.q_lock:
+            # pq's get keeps the timeout it's given as the queue's default for later gets, so put it back
+            default_timeout = self.q.timeout
+            try:
+                item = self.q.get(timeout=timeout)
+            finally:
+                self.q.timeout = default_timeout
+            # pq wakes up on notifications but never consumes them, so don't let them pile up
+            del self.q.conn.notifies[:]
+            if item is None:
+                return None
+
+            claimed = [item]
+            while len(claimed) < self.batch_size:
+                item = self.q.get(block=False)
+                if item is None:
+                    break
+                claimed.append(item)
+
+        with self.in_flight_lock:
+            self.in_flight.update(item.id for item in claimed)
+
+        # Nothing else is ready, so other workers may be idle. Share big items with them.
+        spare_capacity = len(claimed) < self.batch_size
+
+        batches = collections.defaultdict(lambda: ([], []))
+        expired = []
+        for item in claimed:
+            ingest_req = item.data
 
             # Expire out anything whose valid time is very old (probably a bad request/URL)
             if datetime.utcfromtimestamp(ingest_req['valid_time']) < datetime.utcnow() - timedelta(hours=12):
                 logger.info("Expiring old request %s", ingest_req)
+                expired.append(item.id)
                 continue
 
-            # If this URL doesn't exist, try again in a few minutes
-            if not (url_exists(ingest_req['url']) and url_exists(ingest_req['idx_url'])):
-                logger.info("Rescheduling request %s", ingest_req)
-                q.put(ingest_req, '5m')
-                continue
+            if spare_capacity and self.split_groups > 1 and ingest_req.get('field_ids') is None:
+                ingest_req = self.split(ingest_req)
 
-            with tracing.start_span('ingest item') as span:
-                for k, v in ingest_req.items():
-                    span.set_attribute(k, v)
+            field_ids = ingest_req.get('field_ids')
+            reqs, item_ids = batches[(ingest_req['source'], ingest_req['run_time'], tuple(field_ids or ()))]
+            reqs.append(ingest_req)
+            item_ids.append(item.id)
 
-                try:
-                    source = Source.query.filter_by(short_name=ingest_req['source']).first()
+        if expired:
+            self.complete(expired)
 
-                    with tempfile.NamedTemporaryFile() as reduced:
-                        with tracing.start_span('download'):
-                            logging.info(f"Downloading and reducing {ingest_req['url']} from {ingest_req['run_time']} {source.short_name}")
-                            reduce_grib(ingest_req['url'], ingest_req['idx_url'], source.fields, reduced)
-                        with tracing.start_span('ingest'):
-                            logging.info("Ingesting all")
-                            ingest_grib_file(reduced.name, source)
+        return [IngestJob(reqs, item_ids) for reqs, item_ids in batches.values()]
 
-                    source.last_updated = datetime.utcnow()
+    def split(self, ingest_req):
+        """
+        Splits an item into field groups, putting all but the first back in the queue for any worker to take.
+        :return: The first field group's item, to be worked on by this worker
+        """
+        source = Source.query.filter_by(short_name=ingest_req['source']).first()
+        groups = split_field_groups(source, self.split_groups)
+        if len(groups) < 2:
+            return ingest_req
 
-                    db.session.commit()
-                except KeyboardInterrupt:
-                    raise
-                except Exception:
-                    logger.exception("Exception while ingesting %s. Will retry", ingest_req)
-                    q.put(ingest_req, '4m')
+        sub_reqs = [dict(ingest_req, field_ids=group) for group in groups]
+        logger.info("Splitting %s into %d field groups", ingest_req['url'], len(sub_reqs))
+        self.reschedule(sub_reqs[1:], None)
+        return sub_reqs[0]
+
+    def report(self):
+        logger.info("Pipeline stats: %s; %d duplicates skipped",
+                    '; '.join(stage.stats() for stage in self.stages), self.n_skipped)
+
+    def _run_grid_jobs(self):
+        if not self._grids_changed.is_set():
+            return
+        self._grids_changed.clear()
+
+        try:
+            with tracing.start_span('grid jobs'):
+                run_grid_jobs()
+        except Exception:
+            logger.exception("Unable to run grid jobs")
+
+    def _grid_jobs_loop(self):
+        # Its own app context (and so DB session), like the stages
+        with app.app_context():
+            while not self._report_stop.wait(self.grid_jobs_interval):
+                self._run_grid_jobs()
+
+    def _report_loop(self, interval):
+        while not self._report_stop.wait(interval):
+            self.report()
+
+    def stop(self, *_):
+        """
+        Stops claiming new items. Everything already claimed is finished before run returns.
+        Can be used as a signal handler.
+        """
+        logger.info("Stopping, draining claimed items")
+        self._stopping.set()
+
+    def run(self, report_interval=60, forever=False):
+        """
+        :param forever: Keep waiting for new items (woken up by Postgres LISTEN/NOTIFY) until stop is called,
+                        instead of returning once the queue is empty
+        """
+        if forever and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        for stage in self.stages:
+            stage.start()
+
+        threading.Thread(target=self._report_loop, args=(report_interval,), daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+        grid_jobs = get_grid_store() is not None and self.grid_jobs_interval
+        if grid_jobs:
+            grid_jobs_thread = threading.Thread(target=self._grid_jobs_loop, daemon=True)
+            grid_jobs_thread.start()
+
+        try:
+            while not self._stopping.is_set():
+                jobs = self.claim(CLAIM_WAIT if forever else None)
+
+                # Queue is empty for now
+                if jobs is None:
+                    if forever:
+                        continue
+                    logger.info("Empty queue")
+                    break
+
+                for job in jobs:
+                    # Blocks when the download stage is backed up so items aren't claimed before they can be worked on
+                    self.stages[0].in_q.put(job)
+        finally:
+            # Stop stages in order so everything already claimed makes it through the pipeline
+            for stage in self.stages:
+                stage.stop()
+            self._report_stop.set()
+            self.decode_pool.shutdown()
+            self.report()
+
+            if grid_jobs:
+                # Pick up what was stored since the last run
+                grid_jobs_thread.join()
+                self._run_grid_jobs()
+
+
+def ingest_from_queue(forever=False, **pipeline_args):
+    with app.app_context():
+        IngestPipeline(**pipeline_args).run(forever=forever)
 
 
 if __name__ == "__main__":
     init_sentry()
     logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Ingest queued GRIBs')
+    parser.add_argument('--download-workers', type=int, default=2, help='Number of batches downloaded concurrently')
+    parser.add_argument('--decode-workers', type=int, default=2, help='Number of batches decoded concurrently')
+    parser.add_argument('--decode-procs', type=int, default=None, help='Number of decode processes (default: # of CPUs)')
+    parser.add_argument('--store-workers', type=int, default=2, help='Number of batches stored concurrently')
+    parser.add_argument('--batch-size', type=int, default=6, help='Max number of items for the same source and run to ingest together')
+    parser.add_argument('--split-groups', type=int, default=1, help='Number of field groups to split items into when the queue has nothing else ready, so idle workers can share them')
+    parser.add_argument('--grid-jobs-interval', type=int, default=600, help='Min seconds between runs of the grid jobs (blend, daily aggregates) while new grids are stored, if the grid store is enabled. 0 disables them')
+    parser.add_argument('--memory-budget-mb', type=int, default=DEFAULT_MEMORY_BUDGET // 2**20, help='Max MiB of decoded fields each batch holds before storing them')
+    parser.add_argument('--forever', action='store_true', help='Keep waiting for new items instead of exiting once the queue is empty. SIGTERM drains and exits')
+    args = parser.parse_args()
+
     init_tracing('queue_worker')
     with tracing.start_span('queue worker'):
-        ingest_from_queue()
+        ingest_from_queue(
+            forever=args.forever,
+            n_download=args.download_workers,
+            n_decode=args.decode_workers,
+            n_decode_procs=args.decode_procs,
+            n_store=args.store_workers,
+            batch_size=args.batch_size,
+            split_groups=args.split_groups,
+            memory_budget=args.memory_budget_mb * 2**20,
+            grid_jobs_interval=args.grid_jobs_interval,
+        )
@@ -3,10 +3,14 @@ from flask import Blueprint, abort, jsonify, request
 from sqlalchemy import or_
 
 import collections
+import math
+import numpy
 import pytz
 import sqlalchemy
 
 from wx_explore.analysis.summarize import (
+    BLEND_SOURCE,
+    DAILY_SOURCE,
     combine_models,
     SummarizedData,
 )
@@ -15,14 +19,14 @@ from wx_explore.common import (
     tracing,
 )
 from wx_explore.common.models import (
+    DataPointBatch,
     Source,
     SourceField,
     Location,
     Metric,
     Timezone,
 )
-from wx_explore.common.storage import load_data_points
-from wx_explore.common.utils import datetime2unix
+from wx_explore.common.storage import ROLLUP_STATS, load_data_points
 from wx_explore.web.app import app
 
 
@@ -179,26 +183,40 @@ def wx_for_location():
             if end > now + timedelta(days=7):
                 end = now + timedelta(days=7)
 
-    requested_source_fields = SourceField.query.filter(
+    # Statistic of hourly rollups to return in place of sub-hourly data (see storage.ROLLUP_STATS)
+    rollup = request.args.get('rollup')
+    if rollup is not None and rollup not in ROLLUP_STATS:
+        abort(400)
+
+    # Only the models' own fields; synthesized sources (blends, nowcasts, daily aggregates, rollups) have none
+    requested_source_fields = [sf for sf in SourceField.query.filter(
         SourceField.metric_id.in_(metric_ids),
         SourceField.projection_id != None,  # noqa: E711
-    ).all()
+    ).all() if sf.selectors is not None]
 
     with tracing.start_span("load_data_points") as span:
         span.set_attribute("start", str(start))
         span.set_attribute("end", str(end))
         span.set_attribute("source_fields", str(requested_source_fields))
-        data_points = load_data_points((lat, lon), start, end, requested_source_fields)
+        data_points = load_data_points((lat, lon), start, end, requested_source_fields, rollup=rollup)
 
     # valid time -> data points
     datas = collections.defaultdict(list)
 
-    for dp in data_points:
-        datas[datetime2unix(dp.valid_time)].append({
-            'run_time': datetime2unix(dp.run_time),
-            'src_field_id': dp.source_field_id,
-            'value': dp.median(),
-            'raw_values': dp.values,
+    def finite_or_none(value):
+        # Masked cells are stored as NaN, which isn't valid JSON
+        return value if math.isfinite(value) else None
+
+    medians = data_points.medians().tolist()
+    for i, (valid_time, run_time, source_field_id) in enumerate(zip(
+            data_points.valid_time.tolist(),
+            data_points.run_time.tolist(),
+            data_points.source_field_id.tolist())):
+        datas[valid_time].append({
+            'run_time': run_time if run_time != DataPointBatch.NO_TIME else None,
+            'src_field_id': source_field_id if source_field_id != DataPointBatch.NO_FIELD else None,
+            'value': finite_or_none(medians[i]),
+            'raw_values': [finite_or_none(v) for v in data_points.point_values(i).tolist()],
         })
 
     wx = {
@@ -249,12 +267,33 @@ def summarize():
         SourceField.projection_id != None,
     ).all()
 
+    blend_fields = [sf for sf in source_fields if sf.source.short_name == BLEND_SOURCE]
+    # Fields with selectors are the models' own (not synthesized from them)
+    model_fields = [sf for sf in source_fields if sf.selectors is not None]
+
     with tracing.start_span("load_data_points") as span:
         end = start + timedelta(days=days)
         span.set_attribute("start", str(start))
         span.set_attribute("end", str(end))
-        span.set_attribute("source_fields", str(source_fields))
-        data_points = load_data_points((lat, lon), start, end, source_fields)
+
+        blend_points = DataPointBatch.empty()
+        if blend_fields:
+            blend_points = load_data_points((lat, lon), start, end, blend_fields)
+            # Cells no model had a value for are stored as NaN; the models are used there instead
+            blend_points = blend_points.take(~numpy.isnan(blend_points.medians()))
+        model_points = DataPointBatch.empty()
+        if model_fields:
+            # Summaries are hourly, so sub-hourly models' hourly rollups are all that's needed
+            model_points = load_data_points((lat, lon), start, end, model_fields, rollup='mean')
+
+        # Prefer the model blend, falling back to the individual models at the valid times it doesn't have a
+        # metric for (e.g. past the end of the blend or of the models it's made from).
+        # Points are matched on (valid time, metric) packed into one int64.
+        blend_keys = (blend_points.valid_time << 16) + blend_points.metric_id
+        model_keys = (model_points.valid_time << 16) + model_points.metric_id
+        data_points = blend_points + model_points.take(~numpy.isin(model_keys, blend_keys))
+
+        span.set_attribute("source_fields", str(blend_fields + model_fields))
 
     with tracing.start_span("combine_models") as span:
         combined_data_points = combine_models(data_points)
@@ -264,11 +303,27 @@ def summarize():
         last_end = time_ranges[-1][1]
         time_ranges.append((last_end, last_end + timedelta(days=1)))
 
+    # Precomputed aggregates of each whole (UTC) day: day -> metric id -> values.
+    # They cover all 24 hours of their day, so they're only used for ranges which start at midnight. The first range
+    # starts now (unless start is given at a midnight), so it's always summarized from its hourly points.
+    daily = collections.defaultdict(dict)
+    daily_fields = SourceField.query.filter(
+        SourceField.source.has(short_name=DAILY_SOURCE),
+        SourceField.projection_id != None,  # noqa: E711
+    ).all()
+    if daily_fields:
+        with tracing.start_span("load_daily_aggregates") as span:
+            daily_points = load_data_points((lat, lon), time_ranges[0][0], time_ranges[-1][1], daily_fields)
+            # In run time order, so each (day, metric) ends up with the aggregate of its latest run
+            for dp in daily_points.take(numpy.argsort(daily_points.run_time, kind='stable')):
+                daily[dp.valid_time][dp.metric_id] = dp.values
+
     summarizations = []
 
     with tracing.start_span("summarizations") as span:
         for dstart, dend in time_ranges:
-            summary = SummarizedData(dstart, dend, combined_data_points)
+            # Keyed by midnight, so a range starting at any other time never has aggregates
+            summary = SummarizedData(dstart, dend, combined_data_points, daily=daily.get(dstart))
             summarizations.append(summary.dict())
 
     return jsonify(summarizations)